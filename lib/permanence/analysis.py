@@ -0,0 +1,341 @@
+# encoding: utf-8
+
+"""
+Listens to recordings as they are made, to catch dead air and clipping.
+
+Each recording in progress is followed by a thread that reads what has been
+written to the recording's file so far (following a segmented recording
+from segment to segment) and measures it in short windows: the RMS level of
+each window, to find stretches of silence, and the number of samples at or
+near full scale, to find clipping. Problems are reported while the show is
+still being recorded: a silence is reported as soon as it has lasted
+`silence_duration` seconds, and again once it ends; clipping is reported
+once it stops.
+
+Uncompressed WAV (or RF64) files, with 16-bit integer or 32-bit float
+samples as written by the shared JACK client, are read directly. Anything
+else is decoded by ffmpeg, which is fed the file as it grows. The
+measurements need NumPy; without it, recordings cannot be analyzed.
+"""
+
+from __future__ import with_statement
+
+from permanence.event import EventSource
+import subprocess
+import threading
+import traceback
+import struct
+import errno
+import math
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+READ_SIZE = 1024 * 1024
+DECODE_RATE = 44100
+DECODE_CHANNELS = 2
+
+# the settings of LevelAnalyzer that can be configured
+SETTINGS = ("window", "silence_threshold", "silence_duration", "clip_level",
+    "clip_count")
+
+# WAV sample formats: (format tag, bits per sample) -> (dtype, scale)
+WAV_FORMATS = {
+    (1, 16): ("<i2", 32768.0),
+    (3, 32): ("<f4", 1.0)
+}
+
+class LevelAnalyzer(object):
+    """
+    Measures interleaved samples, scaled to [-1, 1], in windows of `window`
+    seconds, and calls `report(kind, start, end)` for each silence or bout
+    of clipping found; `start` and `end` are in seconds from the beginning
+    of the audio, and `end` is None for a silence that is still going on.
+    
+    A window is silent if its RMS level is below `silence_threshold` (in
+    dBFS); only silences that last at least `silence_duration` seconds are
+    reported. A window is clipped if at least `clip_count` of its samples
+    reach `clip_level`.
+    """
+    
+    def __init__(self, sample_rate, channels, report, window=1.0,
+        silence_threshold=-50.0, silence_duration=30.0, clip_level=0.999,
+        clip_count=3):
+        self.window = window
+        self.window_size = max(1, int(sample_rate * window)) * channels
+        self.report = report
+        self.silence_level = 10 ** (silence_threshold / 20.0)
+        self.silence_windows = max(1, int(math.ceil(silence_duration /
+            window)))
+        self.clip_level = clip_level
+        self.clip_count = clip_count
+        self.windows = 0
+        self._remainder = numpy.zeros(0, numpy.float32)
+        self._silence_start = None
+        self._clip_start = None
+    
+    def feed(self, samples):
+        """Measures the given samples (a NumPy array)."""
+        
+        if len(self._remainder):
+            samples = numpy.concatenate((self._remainder, samples))
+        count = len(samples) // self.window_size
+        self._remainder = samples[count * self.window_size:].copy()
+        if not count:
+            return
+        
+        blocks = samples[:count * self.window_size].reshape(count,
+            self.window_size)
+        # sum the squares without making a squared copy of the samples
+        power = numpy.einsum("ij,ij->i", blocks, blocks) / self.window_size
+        silent = numpy.sqrt(power) < self.silence_level
+        clipped = ((blocks >= self.clip_level).sum(axis=1) +
+            (blocks <= -self.clip_level).sum(axis=1)) >= self.clip_count
+        
+        for index in xrange(count):
+            self._measured(self.windows + index, silent[index],
+                clipped[index])
+        self.windows += count
+    
+    def finish(self):
+        """Reports whatever silence or clipping lasted to the end."""
+        
+        self._measured(self.windows, False, False)
+    
+    def _measured(self, index, silent, clipped):
+        if silent:
+            if self._silence_start is None:
+                self._silence_start = index
+            if index - self._silence_start + 1 == self.silence_windows:
+                self.report("silence", self._silence_start * self.window,
+                    None)
+        elif self._silence_start is not None:
+            if index - self._silence_start >= self.silence_windows:
+                self.report("silence", self._silence_start * self.window,
+                    index * self.window)
+            self._silence_start = None
+        
+        if clipped:
+            if self._clip_start is None:
+                self._clip_start = index
+        elif self._clip_start is not None:
+            self.report("clipping", self._clip_start * self.window,
+                index * self.window)
+            self._clip_start = None
+
+def describe_problem(kind, start, end):
+    """Describes a problem reported by a `LevelAnalyzer` in words."""
+    
+    def format_time(seconds):
+        seconds = int(seconds)
+        return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+            seconds % 60)
+    
+    what = {"silence": "silent", "clipping": "clipping"}.get(kind, kind)
+    if end is None:
+        return "%s since %s" % (what, format_time(start))
+    return "%s from %s to %s" % (what, format_time(start), format_time(end))
+
+def read_wav_header(data):
+    """
+    Finds the sample format and the start of the audio in the beginning of
+    a WAV file. Returns (offset, format tag, channels, sample rate, bits per
+    sample), or None if `data` does not yet reach the start of the audio.
+    Raises a ValueError if the data is not a WAV file.
+    """
+    
+    if len(data) < 12:
+        return None
+    if data[:4] not in ("RIFF", "RF64") or data[8:12] != "WAVE":
+        raise ValueError("not a WAV file")
+    
+    offset = 12
+    format = None
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack("<4sI", data[offset:offset + 8])
+        if chunk_id == "fmt ":
+            if offset + 24 > len(data):
+                return None
+            tag, channels, rate = struct.unpack("<HHI",
+                data[offset + 8:offset + 16])
+            bits = struct.unpack("<H", data[offset + 22:offset + 24])[0]
+            format = (tag, channels, rate, bits)
+        elif chunk_id == "data":
+            if format is None:
+                raise ValueError("no format chunk before the audio")
+            return (offset + 8,) + format
+        offset += 8 + size + (size & 1)
+    return None
+
+class WAVDecoder(object):
+    """Reads samples from a WAV file that is being written."""
+    
+    def __init__(self, create_analyzer):
+        self._create_analyzer = create_analyzer
+        self.analyzer = None
+        self._head = ""
+        self._leftover = ""
+    
+    def feed(self, data):
+        if self.analyzer is None:
+            self._head += data
+            header = read_wav_header(self._head)
+            if header is None:
+                return
+            offset, tag, channels, rate, bits = header
+            try:
+                self._dtype, self._scale = WAV_FORMATS[(tag, bits)]
+            except KeyError:
+                raise ValueError("can't analyze WAV files with format %d "
+                    "and %d-bit samples" % (tag, bits))
+            self.analyzer = self._create_analyzer(rate, channels)
+            data, self._head = self._head[offset:], None
+        
+        data = self._leftover + data
+        usable = len(data) - len(data) % numpy.dtype(self._dtype).itemsize
+        self._leftover = data[usable:]
+        samples = numpy.frombuffer(data[:usable], self._dtype)
+        if self._scale != 1.0:
+            samples = samples.astype(numpy.float32) / self._scale
+        self.analyzer.feed(samples)
+    
+    def close(self):
+        if self.analyzer:
+            self.analyzer.finish()
+
+class FFmpegDecoder(object):
+    """
+    Decodes a file in any format that ffmpeg understands, as it is being
+    written, by feeding it to an ffmpeg process.
+    """
+    
+    def __init__(self, create_analyzer, executable="ffmpeg"):
+        self.analyzer = create_analyzer(DECODE_RATE, DECODE_CHANNELS)
+        self._process = subprocess.Popen([executable, "-nostdin", "-v",
+            "error", "-i", "pipe:0", "-f", "f32le", "-ac",
+            str(DECODE_CHANNELS), "-ar", str(DECODE_RATE), "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._read,
+            name="AnalysisDecoderThread")
+        self._reader.setDaemon(True)
+        self._reader.start()
+    
+    def feed(self, data):
+        self._process.stdin.write(data)
+    
+    def close(self):
+        try:
+            self._process.stdin.close()
+        except IOError:
+            pass
+        self._reader.join()
+        self._process.wait()
+    
+    def _read(self):
+        leftover = ""
+        stdout = self._process.stdout
+        for data in iter(lambda: stdout.read(READ_SIZE), ""):
+            data = leftover + data
+            usable = len(data) - len(data) % 4
+            leftover = data[usable:]
+            self.analyzer.feed(numpy.frombuffer(data[:usable], "<f4"))
+        self.analyzer.finish()
+
+class RecordingAnalysis(EventSource):
+    """
+    Follows a session's recording as it is written, and fires "warning"
+    (kind, start, end) for each problem found; see `LevelAnalyzer`. Call
+    `finish` once the session has ended, and the rest of the recording will
+    be analyzed.
+    
+    The recording is the session's `output_path`, or, for sessions whose
+    recorder names the file itself, whatever `find_recorded_file` returns.
+    Until the file has been created, the analysis waits for it.
+    """
+    
+    def __init__(self, session, settings=None, poll_interval=5.0,
+        executable="ffmpeg"):
+        super(RecordingAnalysis, self).__init__()
+        self.session = session
+        self.settings = settings or {}
+        self.poll_interval = poll_interval
+        self.executable = executable
+        self._finished = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+            name="AnalysisThread-%s" % getattr(session, "show_name", ""))
+        self._thread.setDaemon(True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def finish(self):
+        self._finished.set()
+    
+    def _create_analyzer(self, sample_rate, channels):
+        def report(kind, start, end):
+            self.fire("warning", kind=kind, start=start, end=end)
+        return LevelAnalyzer(sample_rate, channels, report, **self.settings)
+    
+    def _open_decoder(self, path):
+        if os.path.splitext(path)[1].lower() == ".wav":
+            return WAVDecoder(self._create_analyzer)
+        return FFmpegDecoder(self._create_analyzer, self.executable)
+    
+    def _get_recording_path(self):
+        find = getattr(self.session, "find_recorded_file", None)
+        if find is not None:
+            return find()
+        return getattr(self.session, "output_path", None)
+    
+    def _open_recording(self, path):
+        try:
+            return open(path, "rb")
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None # not created yet; try again later
+    
+    def _run(self):
+        recording = None
+        decoder = None
+        try:
+            while True:
+                # check for the end first, so that whatever is written before
+                # the session ends is read before stopping
+                finishing = self._finished.isSet()
+                path = self._get_recording_path()
+                if path and (recording is None or path != recording.name):
+                    next_recording = self._open_recording(path)
+                    if next_recording:
+                        if recording:
+                            self._drain(recording, decoder)
+                            recording.close()
+                        recording = next_recording
+                        if decoder is None:
+                            # a segmented recording's segments are decoded
+                            # as one continuous stream
+                            decoder = self._open_decoder(path)
+                
+                if recording:
+                    data = recording.read(READ_SIZE)
+                    if data:
+                        decoder.feed(data)
+                        continue
+                if finishing:
+                    break
+                self._finished.wait(self.poll_interval)
+        except Exception, e:
+            traceback.print_exc()
+            self.fire("error", error="failed to analyze recording: %s" % e)
+        finally:
+            if recording:
+                recording.close()
+            if decoder:
+                decoder.close()
+    
+    def _drain(self, recording, decoder):
+        for data in iter(lambda: recording.read(READ_SIZE), ""):
+            decoder.feed(data)
@@ -10,19 +10,77 @@ Configuration loading and verification for Permanence.
 
 from __future__ import with_statement
 from permanence.hook import add_json_serializer
+from permanence.transcode import parse_encoding
+from permanence import analysis
+import hashlib
 import yaml
 import re
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 class Configuration(object):
     """Configuration settings for Permanence."""
     
-    __slots__ = ["storage", "sources", "hooks", "options"]
+    __slots__ = ["storage", "sources", "hooks", "options", "fingerprints"]
     
-    def __init__(self, storage, sources, hooks, options):
+    def __init__(self, storage, sources, hooks, options, fingerprints=None):
         self.storage = storage
         self.sources = sources
         self.hooks = hooks
         self.options = options
+        self.fingerprints = fingerprints or {}
+
+class ConfigurationDiff(object):
+    """
+    The differences between two configurations.
+    
+    Storage drivers are compared by identity: drivers whose definitions did
+    not change are carried over from the old configuration to the new one by
+    `load_config`, so any driver not present in both is new or discarded.
+    `changed_sources` names the sources that were added, removed or redefined.
+    If the options changed, every source is considered changed.
+    """
+    
+    __slots__ = ["added_storage", "removed_storage", "changed_sources",
+        "hooks_changed", "options_changed"]
+    
+    def __init__(self, old, new):
+        if old is None:
+            old = Configuration({}, {}, None, None)
+        
+        def storage_ids(config):
+            return set(id(driver) for driver in config.storage.itervalues())
+        
+        old_ids, new_ids = storage_ids(old), storage_ids(new)
+        self.added_storage = [driver for driver in new.storage.itervalues()
+            if id(driver) not in old_ids]
+        self.removed_storage = [driver for driver in old.storage.itervalues()
+            if id(driver) not in new_ids]
+        
+        old_fp, new_fp = old.fingerprints, new.fingerprints
+        self.hooks_changed = (not old_fp or
+            old_fp.get("hooks") != new_fp.get("hooks"))
+        self.options_changed = (not old_fp or
+            old_fp.get("options") != new_fp.get("options"))
+        
+        names = set(old.sources.iterkeys()) | set(new.sources.iterkeys())
+        if self.options_changed:
+            self.changed_sources = names
+        else:
+            self.changed_sources = set(name for name in names
+                if old.sources.get(name) is not new.sources.get(name))
+
+def fingerprint(definition):
+    """
+    Returns a stable hash of a configuration definition, which will be the
+    same for any two definitions with the same contents.
+    """
+    
+    encoded = json.dumps(definition, sort_keys=True, default=repr)
+    return hashlib.sha1(encoded).hexdigest()
 
 class RecordingSource(object):
     __slots__ = ["name", "driver", "storage", "shows"]
@@ -65,9 +123,23 @@ class Show(object):
         }
 add_json_serializer(Show, Show.json_friendly)
 
-def load_config(filename):
+def load_config(filename, previous=None):
+    """
+    Loads the configuration file with the given name.
+    
+    If the previously-loaded configuration is given, any storage locations and
+    sources whose definitions have not changed are carried over from it
+    instead of being created again.
+    """
+    
     from permanence.schedule import get_schedule
     
+    if previous is not None and previous.fingerprints:
+        old_fingerprints = previous.fingerprints
+    else:
+        old_fingerprints = {"storage": {}, "sources": {}}
+    fingerprints = {"storage": {}, "sources": {}}
+    
     def read_file():
         with open(filename, "rt") as config_file:
             return yaml.load(config_file)
@@ -86,10 +158,35 @@ def load_config(filename):
         if not storage_type:
             raise ConfigurationError('The type of storage location %r is not '
                 'defined.' % key)
-        storage[key] = get_storage_driver(definition['type'], definition)
+        
+        current = fingerprints['storage'][key] = fingerprint(definition)
+        if current == old_fingerprints['storage'].get(key):
+            storage[key] = previous.storage[key]
+        else:
+            storage[key] = get_storage_driver(definition['type'], definition)
+            if definition.get('encoding'):
+                try:
+                    storage[key].encoding = parse_encoding(
+                        definition['encoding'])
+                except ValueError, e:
+                    raise ConfigurationError('Invalid encoding for storage '
+                        'location %r: %s' % (key, e))
     
     sources = {}
     for source_name, definition in raw['sources'].iteritems():
+        if isinstance(definition, dict):
+            storage_keys = definition.get('storage')
+            if isinstance(storage_keys, basestring):
+                storage_keys = re.split(r'\s*,\s*', storage_keys)
+            if isinstance(storage_keys, list):
+                storage_keys = [fingerprints['storage'].get(key, key)
+                    for key in storage_keys if isinstance(key, basestring)]
+            current = fingerprints['sources'][source_name] = fingerprint(
+                (definition, storage_keys))
+            if current == old_fingerprints['sources'].get(source_name):
+                sources[source_name] = previous.sources[source_name]
+                continue
+        
         for field in ('storage', 'driver', 'shows'):
             if not definition.get(field):
                 raise ConfigurationError('Source %r has no %s defined.' %
@@ -139,12 +236,59 @@ def load_config(filename):
             source_storage, shows)
     
     hooks = raw.get('hooks', {})
+    fingerprints['hooks'] = fingerprint(hooks)
     
     options = raw.get('options', {})
     options.setdefault("leeway", 0)
+    if options.get("spool_quota") is not None:
+        try:
+            options["spool_quota"] = parse_size(options["spool_quota"])
+        except ValueError, e:
+            raise ConfigurationError('Invalid spool quota: %s' % e)
+    if options.get("journal_segment_size") is not None:
+        try:
+            options["journal_segment_size"] = parse_size(
+                options["journal_segment_size"])
+        except ValueError, e:
+            raise ConfigurationError('Invalid journal segment size: %s' % e)
+    # "analysis: true" (or an empty mapping) analyzes with the default
+    # settings; anything else false turns analysis off
+    if options.get("analysis") or options.get("analysis") == {}:
+        if analysis.numpy is None:
+            raise ConfigurationError('Analyzing recordings requires NumPy.')
+        if not isinstance(options["analysis"], dict):
+            options["analysis"] = {}
+        for setting, value in options["analysis"].iteritems():
+            if setting not in analysis.SETTINGS + ("poll_interval",):
+                raise ConfigurationError('Unknown analysis setting %r.' %
+                    setting)
+            try:
+                options["analysis"][setting] = float(value)
+            except (TypeError, ValueError):
+                raise ConfigurationError('Invalid analysis setting %s: %r' %
+                    (setting, value))
+    else:
+        options["analysis"] = None
+    fingerprints['options'] = fingerprint(options)
+    
+    return Configuration(storage, sources, hooks, options, fingerprints)
     
-    return Configuration(storage, sources, hooks, options)
+def parse_size(size):
+    """
+    Converts a size such as "1500", "200M" or "4 GB" into a number of bytes.
+    """
     
+    if isinstance(size, (int, long)):
+        return size
+    
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(size),
+        re.IGNORECASE)
+    if not match:
+        raise ValueError('%r is not a size' % size)
+    
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** " KMGT".index(unit.upper() or " "))
+
 class ConfigurationError(RuntimeError):
     pass
         
@@ -3,21 +3,132 @@
 """
 Makes it easy for objects to generate events and for listeners to respond to
 those events.
+
+Listeners are normally called on the thread that fires the event. A listener
+observed with `asynchronous=True` is instead given its own queue of events,
+which a thread delivers to it, so that the object firing events never waits
+on it. The thread is started when events arrive and exits once the queue has
+been emptied.
+
+An event name ending in "*" observes every event whose name starts with what
+precedes the "*"; "*" alone observes every event. Such listeners are called
+with the name of the event as their first argument.
 """
 
+from __future__ import with_statement
+
+from collections import deque
+import threading
+import traceback
+
+class AsynchronousListener(object):
+    """
+    Delivers events to a listener from a thread of its own.
+    
+    At most `queue_size` events are held for the listener. When the queue is
+    full, the `overflow` policy decides what happens to a new event:
+    "drop_oldest" discards the oldest held event, "drop_newest" discards the
+    new one, and "block" makes the firing thread wait for room.
+    """
+    
+    OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+    
+    def __init__(self, listener, queue_size=1000, overflow="drop_oldest"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy %r" % overflow)
+        
+        self.listener = listener
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.dropped = 0
+        self._queue = deque()
+        self._condition = threading.Condition(threading.Lock())
+        self._running = False
+    
+    def __call__(self, *args, **kwargs):
+        with self._condition:
+            if self.queue_size and len(self._queue) >= self.queue_size:
+                if self.overflow == "drop_newest":
+                    self.dropped += 1
+                    return
+                elif self.overflow == "drop_oldest":
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._queue) >= self.queue_size:
+                        self._condition.wait()
+            
+            self._queue.append((args, kwargs))
+            if not self._running:
+                self._running = True
+                thread = threading.Thread(target=self._deliver,
+                    name="EventListenerThread-%r" % self.listener)
+                thread.start()
+    
+    def _deliver(self):
+        while True:
+            with self._condition:
+                if not self._queue:
+                    self._running = False
+                    return
+                args, kwargs = self._queue.popleft()
+                self._condition.notify()
+            
+            try:
+                self.listener(*args, **kwargs)
+            except Exception:
+                traceback.print_exc()
+
 class EventSource(object):
     def __init__(self):
         super(EventSource, self).__init__()
         self.__event_listeners = {}
+        self.__wildcard_listeners = []
+        self.__resolved = {}
+        self.__lock = threading.Lock()
     
-    def observe(self, event_name, listener):
-        if event_name not in self.__event_listeners:
-            self.__event_listeners[event_name] = []
-        self.__event_listeners[event_name].append(listener)
+    def observe(self, event_name, listener, asynchronous=False,
+        queue_size=1000, overflow="drop_oldest"):
+        """
+        Calls the given listener whenever the named event is fired. See the
+        module documentation for wildcards and for asynchronous listeners.
+        """
+        
+        if asynchronous:
+            listener = AsynchronousListener(listener, queue_size, overflow)
+        
+        with self.__lock:
+            if event_name.endswith("*"):
+                self.__wildcard_listeners.append((event_name[:-1], listener))
+            else:
+                self.__event_listeners.setdefault(event_name,
+                    []).append(listener)
+            self.__resolved = {}
+        return listener
     
     def fire(self, event_name, **kwargs):
-        if event_name not in self.__event_listeners:
-            return
+        try:
+            listeners = self.__resolved[event_name]
+        except KeyError:
+            listeners = self.__resolve(event_name)
         
-        for listener in self.__event_listeners[event_name]:
-            listener(**kwargs)
+        for listener, wildcard in listeners:
+            if wildcard:
+                listener(event_name, **kwargs)
+            else:
+                listener(**kwargs)
+    
+    def __resolve(self, event_name):
+        with self.__lock:
+            listeners = [(listener, False) for listener
+                in self.__event_listeners.get(event_name, ())]
+            listeners.extend((listener, True) for prefix, listener
+                in self.__wildcard_listeners
+                if event_name.startswith(prefix))
+            
+            # replace the cache rather than add to it, so that a concurrent
+            # fire never sees the cache being changed under it
+            resolved = dict(self.__resolved)
+            resolved[event_name] = tuple(listeners)
+            self.__resolved = resolved
+            return resolved[event_name]
@@ -10,26 +10,52 @@ caller accepts returned data from hooks. When external programs, the hook
 arguments are encoded as a JSON object and passed to the program's standard
 input. If the program wishes to return a value, it should encode that value
 in JSON and write it to standard output.
+
+External programs can also be run as persistent hooks. A persistent hook is
+started once and kept running; each invocation is written to its standard
+input as a JSON object on a single line, and it must answer each invocation,
+in order, with a single line on its standard output: either a JSON value or
+an empty line.
+
+Python callables can be run in a pool of worker processes instead of in the
+recorder's own process, so that hooks that do a lot of work do not compete
+with the recorder for the interpreter. The workers import the hook's module
+once, when they start. Since the recorder's objects cannot be sent to another
+process, a pooled hook is called with its arguments in their JSON form, as a
+script hook would receive them, and its return value must be something that
+can be pickled.
 """
 
+from __future__ import with_statement
+
 try:
     import simplejson as json
 except ImportError:
     import json
 
+from collections import deque
+import multiprocessing
 import subprocess
+import threading
+import inspect
+import signal
+import time
 import sys
 import os
 import os.path
 import re
 
-def get_hook(name, exec_search_path):
+def get_hook(name, exec_search_path, persistent=False, max_in_flight=1,
+    processes=None):
     """
     Returns a callable that will invoke the hook with the given name.
     
     The name may refer to a callable in a Python module or an executable file.
     If the name is not an absolute path, executables will be searched for in
-    the given search path.
+    the given search path. If `persistent` is true, an executable is run as a
+    persistent hook that can handle up to `max_in_flight` invocations at once.
+    If `processes` is given, a Python callable is run in a pool of that many
+    worker processes.
     
     If no such hook can be found, returns None.
     """
@@ -39,6 +65,8 @@ def get_hook(name, exec_search_path):
             return None
         if not os.access(path, os.X_OK):
             return None
+        if persistent:
+            return PersistentScriptHook(path, max_in_flight)
         return ExternalScriptHook(path)
     
     if re.match(r'^(/|\\\\|[A-Za-z]:\\)', name):
@@ -64,27 +92,85 @@ def get_hook(name, exec_search_path):
     for path in reversed(exec_search_path):
         sys.path.insert(0, path)
     try:
+        module_name = module
         module = __import__(module, globals(), locals())
-        return getattr(module, hook)
+        callable_hook = getattr(module, hook)
     except (ImportError, AttributeError):
         return None
     finally:
         sys.path = old_path
+    
+    if processes:
+        return PooledPythonHook(module_name, hook, processes,
+            exec_search_path)
+    return callable_hook
 
 class HookExecutionError(RuntimeError):
     pass
 
+class HookTimeoutError(HookExecutionError):
+    pass
+
+def _kill_process(process):
+    # hooks are started in sessions of their own, so that anything they have
+    # started (and that may be holding their output pipes open) dies with them
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        try:
+            process.kill()
+        except OSError:
+            pass # already exited
+
+class HookPayload(object):
+    """
+    The arguments of a hook invocation. The arguments are encoded as JSON the
+    first time a script hook needs them, and the encoding is shared with
+    every other hook given the same payload.
+    """
+    
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self._encoded = None
+        self._error = None
+        self._lock = threading.Lock()
+    
+    def encode(self):
+        with self._lock:
+            if self._encoded is None and self._error is None:
+                try:
+                    self._encoded = _encoder.encode(self.arguments)
+                except (TypeError, ValueError), e:
+                    self._error = "failed to serialize hook arguments: %s" % e
+        
+        if self._error:
+            raise HookExecutionError(self._error)
+        return self._encoded
+    
+    def __len__(self):
+        return len(self.arguments)
+
+def _get_payload(arguments):
+    if isinstance(arguments, HookPayload):
+        return arguments
+    return HookPayload(arguments)
+
 class ExternalScriptHook(object):
     def __init__(self, path):
         self.path = path
     
     def __call__(self, **kwargs):
-        if len(kwargs) > 0:
-            try:
-                data = json.dumps(kwargs, cls=PermanenceJSONEncoder)
-            except (TypeError, ValueError), e:
-                raise HookExecutionError("failed to serialize hook arguments: "
-                    "%s" % e)
+        return self.invoke(kwargs)
+    
+    def invoke(self, arguments, timeout=None):
+        """
+        Runs the hook with the given arguments (a dictionary or HookPayload).
+        If it runs for longer than `timeout` seconds, it is killed.
+        """
+        
+        payload = _get_payload(arguments)
+        if len(payload) > 0:
+            data = payload.encode()
         else:
             data = None
         
@@ -93,9 +179,28 @@ class ExternalScriptHook(object):
         try:
             process = subprocess.Popen(args, executable=self.path,
                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, shell=True, cwd=working)
-            output, error_output = process.communicate(data)
+                stderr=subprocess.PIPE, shell=True, cwd=working,
+                preexec_fn=os.setsid)
+            
+            timed_out = threading.Event()
+            def expire():
+                timed_out.set()
+                _kill_process(process)
+            
+            timer = None
+            if timeout:
+                timer = threading.Timer(timeout, expire)
+                timer.setDaemon(True)
+                timer.start()
+            try:
+                output, error_output = process.communicate(data)
+            finally:
+                if timer:
+                    timer.cancel()
             
+            if timed_out.isSet():
+                raise HookTimeoutError("hook timed out after %s seconds" %
+                    timeout)
             if process.returncode != 0:
                 raise HookExecutionError("hook exited with error status %d" %
                     process.returncode)
@@ -110,14 +215,333 @@ class ExternalScriptHook(object):
     def __repr__(self):
         return "%s(%r)" % (type(self).__name__, self.path)
 
+class PersistentScriptHook(object):
+    """
+    Runs an executable hook once and sends it each invocation over a pipe;
+    see the module documentation for the protocol.
+    
+    Up to `max_in_flight` invocations may be waiting on the hook at once.
+    If the hook exits, any invocations it had not answered fail, and it is
+    started again for the next invocation. Once the hook is no longer
+    needed, call `close` to stop it.
+    """
+    
+    class Reply(object):
+        def __init__(self):
+            self.value = None
+            self.error = None
+            self._ready = threading.Event()
+        
+        def set(self, value=None, error=None):
+            self.value = value
+            self.error = error
+            self._ready.set()
+        
+        def wait_until_ready(self, timeout=None):
+            self._ready.wait(timeout)
+            return self._ready.isSet()
+        
+        def get(self):
+            if self.error:
+                raise HookExecutionError(self.error)
+            return self.value
+    
+    def __init__(self, path, max_in_flight=1):
+        self.path = path
+        self.max_in_flight = max_in_flight
+        self._slots = threading.Semaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._process = None
+        self._waiting = None
+        self._reader = None
+        self._closed = False
+    
+    def __call__(self, **kwargs):
+        return self.invoke(kwargs)
+    
+    def invoke(self, arguments, timeout=None):
+        """
+        Sends an invocation to the hook and waits for its answer. The
+        arguments may be a dictionary or HookPayload. If the hook has not
+        taken the invocation and answered it within `timeout` seconds, it is
+        killed.
+        """
+        
+        data = _get_payload(arguments).encode()
+        
+        self._slots.acquire()
+        try:
+            deadline = (time.time() + timeout) if timeout else None
+            reply = self.Reply()
+            # invocations are written in the order their replies are expected
+            # in; the reply reader only needs the main lock, so it can keep
+            # taking replies while a large invocation is being written
+            with self._write_lock:
+                with self._lock:
+                    process, waiting = self._get_process()
+                    waiting.append(reply)
+                
+                # a hook that stops reading its input would block the write
+                # forever; killing it at the deadline makes the write fail
+                timed_out = threading.Event()
+                def expire():
+                    timed_out.set()
+                    _kill_process(process)
+                
+                timer = None
+                if deadline:
+                    timer = threading.Timer(max(0, deadline - time.time()),
+                        expire)
+                    timer.setDaemon(True)
+                    timer.start()
+                try:
+                    process.stdin.write(data + "\n")
+                    process.stdin.flush()
+                except (IOError, OSError, ValueError), e:
+                    with self._lock:
+                        if reply in waiting:
+                            waiting.remove(reply)
+                    _kill_process(process)
+                    if timed_out.isSet():
+                        raise HookTimeoutError("hook timed out after %s "
+                            "seconds" % timeout)
+                    raise HookExecutionError("failed to send invocation to "
+                        "hook: %s" % e)
+                finally:
+                    if timer:
+                        timer.cancel()
+            
+            remaining = None
+            if deadline:
+                remaining = max(0, deadline - time.time())
+            if not reply.wait_until_ready(remaining) or timed_out.isSet():
+                _kill_process(process)
+                raise HookTimeoutError("hook timed out after %s seconds" %
+                    timeout)
+            return reply.get()
+        finally:
+            self._slots.release()
+    
+    def close(self):
+        """
+        Stops the hook. Any invocations it has not yet answered fail.
+        """
+        
+        with self._lock:
+            self._closed = True
+            process, self._process = self._process, None
+            reader, self._reader = self._reader, None
+        if process is None:
+            return
+        
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass # an invocation is still being written; the kill stops it
+        _kill_process(process)
+        if reader:
+            reader.join()
+    
+    def _get_process(self):
+        # must be called with the lock held
+        if self._closed:
+            raise HookExecutionError("hook has been closed")
+        if self._process is None or self._process.poll() is not None:
+            try:
+                null = open(os.devnull, "w")
+                try:
+                    self._process = subprocess.Popen([self.path],
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        stderr=null, cwd=os.path.dirname(self.path),
+                        close_fds=True, preexec_fn=os.setsid)
+                finally:
+                    null.close()
+            except OSError, e:
+                self._process = None
+                raise HookExecutionError("failed to execute hook: %s" % e)
+            
+            self._waiting = deque()
+            self._reader = threading.Thread(target=self._read_replies,
+                args=(self._process, self._waiting),
+                name="HookReader-%d" % self._process.pid)
+            self._reader.setDaemon(True)
+            self._reader.start()
+        return self._process, self._waiting
+    
+    def _read_replies(self, process, waiting):
+        for line in iter(process.stdout.readline, ""):
+            with self._lock:
+                if not waiting:
+                    continue # unsolicited output; ignore it
+                reply = waiting.popleft()
+            
+            line = line.strip()
+            try:
+                reply.set(json.loads(line) if line else None)
+            except ValueError:
+                reply.set(None)
+        
+        # the hook exited (or closed its output)
+        status = process.wait()
+        with self._lock:
+            failed = list(waiting)
+            waiting.clear()
+            if self._process is process:
+                self._process = None
+        
+        for reply in failed:
+            reply.set(error="hook exited with status %d" % status)
+    
+    def __repr__(self):
+        return "%s(%r, %r)" % (type(self).__name__, self.path,
+            self.max_in_flight)
+
+def _initialize_pool_worker(module_name, attribute, search_path):
+    global _pooled_hook
+    
+    # leave signals to the recorder
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    
+    sys.path[:0] = search_path
+    __import__(module_name)
+    _pooled_hook = getattr(sys.modules[module_name], attribute)
+
+def _run_pooled_hook(data):
+    # runs in a pool worker; exceptions are returned as text so that they can
+    # be sent back whether or not they can be pickled
+    try:
+        arguments = json.loads(data) if data else {}
+        arguments = dict((str(key), value) for key, value
+            in arguments.iteritems())
+        return (True, _pooled_hook(**arguments))
+    except Exception, e:
+        return (False, "%s: %s" % (type(e).__name__, e))
+
+class PooledPythonHook(object):
+    """
+    Runs a Python hook in a pool of worker processes; see the module
+    documentation.
+    
+    A call that runs past its timeout causes the pool to be terminated; a new
+    pool is started for the next invocation.
+    """
+    
+    def __init__(self, module_name, attribute, processes, search_path=None):
+        self.module_name = module_name
+        self.attribute = attribute
+        self.processes = processes
+        self.search_path = list(search_path or [])
+        self._lock = threading.Lock()
+        self._pool = None
+        self._closed = False
+        
+        # start the workers now so that they are warm for the first event
+        self._get_pool()
+    
+    def __call__(self, **kwargs):
+        return self.invoke(kwargs)
+    
+    def invoke(self, arguments, timeout=None):
+        """
+        Calls the hook in a worker process with the given arguments (a
+        dictionary or HookPayload) and returns its result. If it does not
+        return within `timeout` seconds, the pool is terminated.
+        """
+        
+        payload = _get_payload(arguments)
+        data = payload.encode() if len(payload) > 0 else None
+        
+        pool = self._get_pool()
+        try:
+            result = pool.apply_async(_run_pooled_hook, (data,))
+        except (AssertionError, ValueError), e:
+            # the pool was closed or terminated in the meantime
+            raise HookExecutionError("hook pool is not running: %s" % e)
+        
+        try:
+            # (waiting without any timeout cannot be interrupted)
+            succeeded, value = result.get(timeout or sys.maxint)
+        except multiprocessing.TimeoutError:
+            self._discard_pool(pool)
+            raise HookTimeoutError("hook timed out after %s seconds" %
+                timeout)
+        except Exception, e:
+            raise HookExecutionError("failed to run hook: %s" % e)
+        
+        if not succeeded:
+            raise HookExecutionError(value)
+        return value
+    
+    def close(self):
+        """
+        Shuts down the worker processes once they have finished the calls
+        given to them.
+        """
+        
+        with self._lock:
+            self._closed = True
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.close()
+    
+    def _get_pool(self):
+        with self._lock:
+            if self._closed:
+                raise HookExecutionError("hook has been closed")
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes,
+                    _initialize_pool_worker, (self.module_name,
+                    self.attribute, self.search_path))
+            return self._pool
+    
+    def _discard_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.terminate()
+    
+    def __repr__(self):
+        return "%s(%r, %r, %r)" % (type(self).__name__,
+            "%s.%s" % (self.module_name, self.attribute), self.processes,
+            self.search_path)
+
 class PermanenceJSONEncoder(json.JSONEncoder):
-    encoders = []
+    """
+    Encodes objects of the types registered with `add_json_serializer`.
+    
+    The serializer for an object is the one registered for the nearest class
+    in its class's method resolution order; the answer is cached per class.
+    """
+    
+    encoders = {}
+    _resolved = {}
     
     def default(self, obj):
-        for custom_type, encoder in self.encoders:
-            if isinstance(obj, custom_type):
-                return encoder(obj)
-        return json.JSONEncoder.default(obj)
+        cls = getattr(obj, "__class__", type(obj))
+        try:
+            encoder = self._resolved[cls]
+        except KeyError:
+            encoder = self._resolve(cls)
+        
+        if encoder is None:
+            return json.JSONEncoder.default(self, obj)
+        return encoder(obj)
+    
+    @classmethod
+    def _resolve(cls, obj_class):
+        encoder = None
+        for base in inspect.getmro(obj_class):
+            if base in cls.encoders:
+                encoder = cls.encoders[base]
+                break
+        cls._resolved[obj_class] = encoder
+        return encoder
 
 def add_json_serializer(custom_type, encoder):
-    PermanenceJSONEncoder.encoders.append((custom_type, encoder))
+    PermanenceJSONEncoder.encoders[custom_type] = encoder
+    PermanenceJSONEncoder._resolved.clear()
+
+_encoder = PermanenceJSONEncoder()
@@ -0,0 +1,337 @@
+# encoding: utf-8
+
+"""
+An append-only journal of recorder events.
+
+The journal is a directory of segment files. Each segment holds events as
+JSON objects, one per line, with the time of the event, its name, and its
+arguments; sources and shows are recorded by name. A segment is sealed once
+it grows past a size limit, and an index of the segment is then written next
+to it, giving the time range it covers and the offset of each event by
+(source, show). Queries read only the indexes of the segments outside the
+range they ask about, and only the matching lines of the others.
+"""
+
+from __future__ import with_statement
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from bisect import bisect_left, bisect_right
+import threading
+import time
+import glob
+import re
+import os
+import os.path
+
+SEGMENT_PATTERN = "journal-%08d.log"
+INDEX_SUFFIX = ".idx"
+
+def _simplify(value):
+    """Converts an event argument into something that can be encoded."""
+    
+    if value is None or isinstance(value, (basestring, bool, int, long,
+        float)):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return [_simplify(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((str(key), _simplify(item))
+            for key, item in value.iteritems())
+    
+    name = getattr(value, "name", None)
+    if isinstance(name, basestring):
+        return name
+    try:
+        return unicode(value)
+    except UnicodeError:
+        return repr(value)
+
+class SegmentIndex(object):
+    """
+    The time range covered by a segment and the offsets of its events, by
+    (source, show). Events without a source or show are indexed under None
+    in its place.
+    """
+    
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.count = 0
+        self.size = 0
+        self.keys = {}
+    
+    def add(self, record, offset, length):
+        when = record["time"]
+        if self.first is None or when < self.first:
+            self.first = when
+        if self.last is None or when > self.last:
+            self.last = when
+        self.count += 1
+        self.size = offset + length
+        
+        key = (record.get("source"), record.get("show"))
+        entries = self.keys.setdefault(key, ([], []))
+        entries[0].append(when)
+        entries[1].append(offset)
+    
+    def overlaps(self, since, until):
+        if self.first is None:
+            return False
+        if since is not None and self.last < since:
+            return False
+        if until is not None and self.first > until:
+            return False
+        return True
+    
+    def find(self, source=None, show=None, since=None, until=None):
+        """Returns the offsets of the matching events, in file order."""
+        
+        offsets = []
+        for (key_source, key_show), (times, key_offsets) in self.keys.items():
+            if source is not None and key_source != source:
+                continue
+            if show is not None and key_show != show:
+                continue
+            
+            start = 0 if since is None else bisect_left(times, since)
+            end = len(times) if until is None else bisect_right(times, until)
+            offsets.extend(key_offsets[start:end])
+        offsets.sort()
+        return offsets
+    
+    def to_json(self):
+        return {
+            "first": self.first,
+            "last": self.last,
+            "count": self.count,
+            "size": self.size,
+            "keys": [[source, show, times, offsets] for (source, show),
+                (times, offsets) in self.keys.iteritems()]
+        }
+    
+    @classmethod
+    def from_json(cls, data):
+        index = cls()
+        index.first = data["first"]
+        index.last = data["last"]
+        index.count = data["count"]
+        index.size = data["size"]
+        for source, show, times, offsets in data["keys"]:
+            index.keys[(source, show)] = (times, offsets)
+        return index
+    
+    @classmethod
+    def scan(cls, segment_file):
+        """
+        Builds the index of a segment by reading it. Reading stops at the
+        first incomplete or damaged line.
+        """
+        
+        index = cls()
+        segment_file.seek(0)
+        offset = 0
+        for line in iter(segment_file.readline, ""):
+            if not line.endswith("\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            index.add(record, offset, len(line))
+            offset += len(line)
+        return index
+
+class JournalReader(object):
+    """Queries the journal in a directory."""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self._indexes = {}
+    
+    def query(self, source=None, show=None, event=None, since=None,
+        until=None):
+        """
+        Yields the events that match all of the given criteria, oldest first,
+        as dictionaries. `since` and `until` are Unix times, and `event` may
+        be a single event name or a collection of them.
+        """
+        
+        if isinstance(event, basestring):
+            event = (event,)
+        
+        for number, path in self._get_segments():
+            index = self._get_index(number, path)
+            if not index.overlaps(since, until):
+                continue
+            
+            offsets = index.find(source, show, since, until)
+            if not offsets:
+                continue
+            
+            with open(path, "rb") as segment_file:
+                for offset in offsets:
+                    segment_file.seek(offset)
+                    record = json.loads(segment_file.readline())
+                    if event is None or record["event"] in event:
+                        yield record
+    
+    def replay(self, listener, **criteria):
+        """
+        Calls the given listener as listener(event_name, **arguments) for
+        each event that matches the given criteria (see `query`), in order.
+        """
+        
+        for record in self.query(**criteria):
+            arguments = dict((str(key), value)
+                for key, value in record.iteritems())
+            listener(arguments.pop("event"), **arguments)
+    
+    def _get_segments(self):
+        pattern = re.compile(r"^journal-(\d+)\.log$")
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, "journal-*.log")):
+            match = pattern.match(os.path.basename(path))
+            if match:
+                segments.append((int(match.group(1)), path))
+        segments.sort()
+        return segments
+    
+    def _get_index(self, number, path):
+        index = self._indexes.get(number)
+        if index is not None:
+            return index
+        
+        try:
+            with open(path + INDEX_SUFFIX, "rb") as index_file:
+                index = SegmentIndex.from_json(json.load(index_file))
+        except (IOError, ValueError, KeyError):
+            # the segment has not been sealed; read it as it is now
+            with open(path, "rb") as segment_file:
+                return SegmentIndex.scan(segment_file)
+        
+        self._indexes[number] = index
+        return index
+
+class EventJournal(JournalReader):
+    """
+    Writes events to the journal in a directory.
+    
+    Events are written as they are recorded, but are only flushed to disk
+    (with fsync) at most every `sync_interval` seconds, and whenever a
+    segment is sealed or the recorder shuts down. Segments are sealed when
+    they reach `segment_size` bytes.
+    
+    `record` has the signature of a wildcard event listener, so a journal
+    can observe every event of an event source directly.
+    """
+    
+    def __init__(self, directory, segment_size=1048576, sync_interval=1.0):
+        super(EventJournal, self).__init__(directory)
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._timer = None
+        self._dirty = False
+        
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._open_segment()
+    
+    def record(self, event_name, **arguments):
+        record = dict((key, _simplify(value))
+            for key, value in arguments.iteritems())
+        record["time"] = time.time()
+        record["event"] = event_name
+        line = json.dumps(record) + "\n"
+        
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(line)
+            self._active_index.add(record, offset, len(line))
+            
+            if self._file.tell() >= self.segment_size:
+                self._seal_segment()
+                self._open_segment()
+            elif event_name == "shutdown":
+                self._sync()
+            elif not self._dirty:
+                self._dirty = True
+                self._timer = threading.Timer(self.sync_interval, self.sync)
+                self._timer.setDaemon(True)
+                self._timer.start()
+    
+    def sync(self):
+        """Flushes the events recorded so far to disk."""
+        
+        with self._lock:
+            self._sync()
+    
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+    
+    def _sync(self):
+        # must be called with the lock held
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._dirty = False
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+    
+    def _open_segment(self):
+        # must be called with the lock held (or from the constructor)
+        segments = self._get_segments()
+        if segments:
+            number, path = segments[-1]
+            if not os.path.exists(path + INDEX_SUFFIX):
+                # carry on with the segment that was being written; anything
+                # after its last complete event is discarded
+                self._file = open(path, "r+b")
+                self._active_index = SegmentIndex.scan(self._file)
+                self._file.seek(self._active_index.size)
+                self._file.truncate()
+                self._active_number = number
+                return
+            number += 1
+        else:
+            number = 1
+        
+        path = os.path.join(self.directory, SEGMENT_PATTERN % number)
+        self._file = open(path, "ab")
+        self._active_index = SegmentIndex()
+        self._active_number = number
+    
+    def _seal_segment(self):
+        # must be called with the lock held
+        self._sync()
+        self._file.close()
+        
+        path = self._file.name + INDEX_SUFFIX
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as index_file:
+            json.dump(self._active_index.to_json(), index_file)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.rename(temp_path, path)
+        
+        self._indexes[self._active_number] = self._active_index
+    
+    def _get_index(self, number, path):
+        with self._lock:
+            if number == self._active_number:
+                return self._active_index
+        return super(EventJournal, self)._get_index(number, path)
+    
+    def query(self, *args, **kwargs):
+        # make sure that the active segment can be read back
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+        return super(EventJournal, self).query(*args, **kwargs)
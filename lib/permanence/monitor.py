@@ -2,12 +2,25 @@
 
 """
 Process monitoring.
+
+The monitor blocks until the kernel reports that a child has exited instead
+of polling its children. On Linux, each child is watched through a process
+file descriptor (pidfd) registered with epoll; elsewhere, each child gets a
+thread that blocks in `waitpid`. Exit callbacks are run on a separate
+dispatch thread so that a slow callback does not delay noticing that other
+children have exited.
 """
 
+from __future__ import with_statement
+
 from permanence.event import EventSource
-from collections import deque
+from Queue import Queue
 import threading
-import time
+import traceback
+import select
+import errno
+import sys
+import os
 
 def monitor_process(open_process, callback):
     """
@@ -18,12 +31,149 @@ def monitor_process(open_process, callback):
     
     ProcessMonitor.get_instance().monitor(open_process, callback)
 
+def _get_pidfd_open():
+    """
+    Returns a function that opens a pidfd for a process ID, or None if pidfds
+    cannot be used on this system.
+    """
+    
+    if hasattr(os, "pidfd_open"):
+        pidfd_open = os.pidfd_open
+    elif sys.platform.startswith("linux"):
+        try:
+            import ctypes
+            syscall = ctypes.CDLL(None, use_errno=True).syscall
+        except (ImportError, OSError, AttributeError):
+            return None
+        
+        def pidfd_open(pid, flags=0):
+            fd = syscall(434, pid, flags) # __NR_pidfd_open
+            if fd < 0:
+                code = ctypes.get_errno()
+                raise OSError(code, os.strerror(code))
+            return fd
+    else:
+        return None
+    
+    if not hasattr(select, "epoll"):
+        return None
+    
+    try:
+        os.close(pidfd_open(os.getpid()))
+    except OSError:
+        # kernel is older than 5.3
+        return None
+    return pidfd_open
+
+class PidfdBackend(object):
+    """
+    Waits for processes to exit by polling their pidfds with epoll from a
+    single thread. The thread sleeps until one of the processes exits.
+    """
+    
+    def __init__(self, pidfd_open, exited):
+        self._pidfd_open = pidfd_open
+        self._exited = exited
+        self._epoll = select.epoll()
+        self._wake_read, self._wake_write = os.pipe()
+        self._epoll.register(self._wake_read, select.EPOLLIN)
+        self._descriptors = {}
+        self._lock = threading.Lock()
+        self._active = False
+        self._thread = None
+    
+    def start(self):
+        self._active = True
+        self._thread = threading.Thread(target=self._run,
+            name="ProcessMonitorThread")
+        self._thread.start()
+    
+    def stop(self):
+        self._active = False
+        os.write(self._wake_write, "x")
+    
+    def add(self, process):
+        try:
+            fd = self._pidfd_open(process.pid)
+        except OSError:
+            # the process is already gone
+            process.poll()
+            self._exited(process)
+            return
+        
+        with self._lock:
+            self._descriptors[fd] = process
+        self._epoll.register(fd, select.EPOLLIN)
+    
+    def _run(self):
+        try:
+            while self._active:
+                try:
+                    events = self._epoll.poll()
+                except (IOError, OSError), e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                
+                for fd, mask in events:
+                    if fd == self._wake_read:
+                        os.read(fd, 512)
+                        continue
+                    
+                    with self._lock:
+                        process = self._descriptors.pop(fd, None)
+                    self._epoll.unregister(fd)
+                    os.close(fd)
+                    if process is not None:
+                        process.poll()
+                        self._exited(process)
+        finally:
+            self._close()
+    
+    def _close(self):
+        with self._lock:
+            for fd in self._descriptors:
+                os.close(fd)
+            self._descriptors.clear()
+        self._epoll.close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+class WaiterBackend(object):
+    """
+    Waits for each process to exit in its own thread, which blocks in
+    `waitpid` until it does.
+    """
+    
+    def __init__(self, exited):
+        self._exited = exited
+    
+    def start(self):
+        pass
+    
+    def stop(self):
+        pass
+    
+    def add(self, process):
+        thread = threading.Thread(target=self._wait, args=(process,),
+            name="ProcessWaiterThread-%d" % process.pid)
+        thread.setDaemon(True)
+        thread.start()
+    
+    def _wait(self, process):
+        process.wait()
+        self._exited(process)
+
 class ProcessMonitor(EventSource):
     def __init__(self):
         super(ProcessMonitor, self).__init__()
-        self.__processes = deque()
+        self.__processes = {}
+        self.__empty_callbacks = []
+        self.__lock = threading.Lock()
+        self._backend = None
         self._thread = None
-        
+        self._active = False
+    
     @classmethod
     def get_instance(cls):
         if not hasattr(cls, "_global_instance"):
@@ -31,51 +181,82 @@ class ProcessMonitor(EventSource):
         return cls._global_instance
     
     def monitor(self, process, callback):
-        self.__processes.append((process, callback))
+        with self.__lock:
+            self.__processes[process.pid] = (process, callback)
+            if not self._thread:
+                self.start()
         
-        if not self._thread:
-            self.start()
-            
+        self._backend.add(process)
+    
+    def get_process_count(self):
+        with self.__lock:
+            return len(self.__processes)
+    
+    def when_empty(self, callback):
+        """
+        Calls the given callback once no monitored processes remain (and the
+        exit callbacks of any that have exited have all been run). If there
+        are no processes now, the callback is called immediately.
+        """
+        
+        with self.__lock:
+            if self.__processes:
+                self.__empty_callbacks.append(callback)
+                return
+        callback()
+    
     def start(self):
         if self._thread:
             raise RuntimeError("process monitor already started")
         
-        self._thread = threading.Thread(target=self._check_processes,
-            name="ProcessMonitorThread")
+        pidfd_open = _get_pidfd_open()
+        if pidfd_open:
+            self._backend = PidfdBackend(pidfd_open, self._process_exited)
+        else:
+            self._backend = WaiterBackend(self._process_exited)
+        
+        self._callbacks = Queue(0)
+        self._thread = threading.Thread(target=self._dispatch_callbacks,
+            name="ProcessCallbackThread")
         self._active = True
+        self._backend.start()
         self._thread.start()
     
     def halt(self):
-        self._active = False
+        if not self._active:
+            return
         
-    def _check_processes(self):
+        self._active = False
+        self._backend.stop()
+        self._callbacks.put(None)
+    
+    def _process_exited(self, process):
+        self._callbacks.put(process)
+    
+    def _dispatch_callbacks(self):
         while self._active:
+            process = self._callbacks.get()
+            if process is None:
+                continue
+            
+            with self.__lock:
+                entry = self.__processes.get(process.pid)
+            if entry is None:
+                continue
+            
             try:
-                first_seen = None
-                while len(self.__processes) > 0:
-                    process, callback = self.__processes.popleft()
-                    if not first_seen:
-                        first_seen = process
-                    elif process is first_seen:
-                        self.__processes.append((process, callback))
-                        break
-                    
-                    process.poll()
-                    if process.returncode is not None:
-                        try:
-                            callback(process.returncode)
-                        except Exception:
-                            # this thread is doomed. ensure it rises again.
-                            self._thread = None
-                            self.start()
-                            raise
-                        if process is first_seen:
-                            first_seen = None
-                    else:
-                        self.__processes.append((process, callback))
-            except IndexError:
-                pass
+                entry[1](process.returncode)
+            except Exception:
+                traceback.print_exc()
+            
+            with self.__lock:
+                del self.__processes[process.pid]
+                empty = not self.__processes
+                if empty:
+                    callbacks = self.__empty_callbacks
+                    self.__empty_callbacks = []
             
-            if len(self.__processes) <= 0:
+            if empty:
                 self.fire("empty")
-            time.sleep(0.25)
+                for callback in callbacks:
+                    callback()
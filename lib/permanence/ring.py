@@ -0,0 +1,131 @@
+# encoding: utf-8
+
+"""
+A fixed-size ring buffer, kept in a memory-mapped file, of the most recent
+audio captured from a source.
+
+A source that captures continuously writes everything it receives into its
+ring, overwriting the oldest data once the ring is full, so the ring always
+holds the last `size` bytes of the source. Recordings that start late (such
+as a show added to the configuration after it began) can then begin with
+what the ring still holds from the show's scheduled start. Data is taken out
+of the ring by the kernel, straight from the ring's file into the
+recording's.
+"""
+
+from __future__ import with_statement
+
+from permanence.storage.util import copy_range
+from collections import deque
+import threading
+import mmap
+import time
+import os
+
+class RingBuffer(object):
+    """
+    Holds the last `size` bytes written to it in the file at `path`.
+    
+    Every `MARK_INTERVAL` seconds, a write records the time along with its
+    position in the stream of data written to the ring, so that data can be
+    found again by when it was written. Marks that refer to data that has
+    been overwritten are forgotten, and at most `MAX_MARKS` are kept, so the
+    ring uses a fixed amount of memory and disk however long it runs.
+    """
+    
+    MARK_INTERVAL = 1.0
+    MAX_MARKS = 100000
+    
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.total = 0
+        self._marks = deque()
+        self._horizon = (0, 0)
+        self._lock = threading.Lock()
+        
+        self._file = open(path, "w+b")
+        try:
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+        except:
+            self._file.close()
+            os.remove(path)
+            raise
+    
+    def write(self, data):
+        """Adds data to the ring, overwriting the oldest data if need be."""
+        
+        now = time.time()
+        with self._lock:
+            last_mark = self._marks[-1][0] if self._marks else None
+            if last_mark is None or now - last_mark >= self.MARK_INTERVAL:
+                self._marks.append((now, self.total))
+                if len(self._marks) > self.MAX_MARKS:
+                    self._horizon = self._marks.popleft()
+            
+            length = len(data)
+            if length > self.size:
+                self.total += length - self.size
+                data = data[-self.size:]
+                length = self.size
+            
+            position = self.total % self.size
+            first = min(length, self.size - position)
+            self._map[position:position + first] = data[:first]
+            if first < length:
+                self._map[0:length - first] = data[first:]
+            self.total += length
+            
+            oldest = self.total - self.size
+            while self._marks and self._marks[0][1] < oldest:
+                self._horizon = self._marks.popleft()
+    
+    def extract(self, since, dest):
+        """
+        Appends the data written to the ring since the given time to the open
+        file `dest`. Returns the time at which the first byte copied was
+        written (None if nothing was copied) and the number of bytes copied.
+        
+        Data is located to within `MARK_INTERVAL` seconds; copying starts
+        with the first mark at or after `since`, or with the oldest data in
+        the ring if `since` is older than every mark.
+        """
+        
+        with self._lock:
+            if self._marks and since >= self._marks[0][0]:
+                start = None
+                for mark_time, offset in self._marks:
+                    if mark_time >= since:
+                        start = (mark_time, offset)
+                        break
+                if start is None:
+                    return (None, 0)
+            elif self.total:
+                # start from the last forgotten mark, or from the oldest data
+                # if that mark's data has been overwritten
+                horizon_time, horizon_offset = self._horizon
+                start = (max(since, horizon_time), max(horizon_offset,
+                    self.total - self.size))
+            else:
+                return (None, 0)
+            
+            start_time, offset = start
+            length = self.total - offset
+            position = offset % self.size
+            first = min(length, self.size - position)
+            copy_range(self._file, dest, position, first)
+            if first < length:
+                copy_range(self._file, dest, 0, length - first)
+            return (start_time, length)
+    
+    def close(self):
+        """Releases the ring and deletes its file."""
+        
+        with self._lock:
+            self._map.close()
+            self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
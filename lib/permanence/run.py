@@ -6,39 +6,103 @@ The heart of the beast: brings all the parts together to make recordings.
 
 from __future__ import with_statement
 
+from permanence.config import ConfigurationDiff
 from permanence.event import EventSource
 from permanence.monitor import ProcessMonitor
-from permanence.hook import get_hook
+from permanence.journal import EventJournal
+from permanence.hook import get_hook, HookPayload, HookTimeoutError
+from permanence.schedule import ScheduleCalendar
+from permanence.storage.pipeline import StoragePipeline
+from permanence.temp import get_spool
+from permanence.transcode import Transcoder
+from permanence.analysis import RecordingAnalysis, describe_problem
 import threading
 import time
+import heapq
+import itertools
 import contextlib
-from Queue import Queue
+from collections import deque, OrderedDict
 
 class ShowManager(EventSource):
+    """
+    Keeps track of when each show should next be recorded.
+    
+    Start and stop deadlines are kept in heaps so that finding the shows that
+    are due does not require looking at every show. Heap entries are never
+    removed eagerly; an entry that no longer matches its show's current state
+    is simply discarded when it reaches the top of the heap.
+    
+    If a show's source driver has a `lead_time`, the show also has a prepare
+    deadline that many seconds before it starts, at which its session should
+    be created and prepared, so that it is ready to record the moment the
+    show starts. Prepared sessions that will no longer be used (because the
+    show was rescheduled or removed) are handed back by
+    `get_abandoned_sessions`.
+    """
+    
     class ManagedShow(object):
         def __init__(self, token, source, start_time, duration):
             self.token = token
             self.source = source
             self.start_time = start_time
+            self.next_attempt = start_time
             self.duration = duration
             self.session = None
             self.stop_time = None
+            self.prepared = None
+        
+        def get_prepare_time(self):
+            lead_time = getattr(self.source, "lead_time", 0)
+            if not lead_time or self.start_time is None:
+                return None
+            return self.start_time - lead_time
     
     def __init__(self):
         super(ShowManager, self).__init__()
         self._shows = {}
+        self._source_keys = {}
+        self._starts = []
+        self._stops = []
+        self._prepares = []
+        self._abandoned = []
+        self._sequence = itertools.count()
         self._show_access = threading.RLock()
+        self.calendar = ScheduleCalendar()
     
     def _get_next_time(self, schedule, leeway):
-        return schedule.get_next_time(leeway) or (None, None)
+        return self.calendar.get_next_time(schedule, leeway) or (None, None)
+    
+    def _push_start(self, key, start_time):
+        if start_time is not None:
+            heapq.heappush(self._starts,
+                (start_time, self._sequence.next(), key))
+    
+    def _push_stop(self, key, stop_time):
+        if stop_time is not None:
+            heapq.heappush(self._stops,
+                (stop_time, self._sequence.next(), key))
+    
+    def _push_prepare(self, key, show):
+        prepare_time = show.get_prepare_time()
+        if prepare_time is not None:
+            heapq.heappush(self._prepares,
+                (prepare_time, self._sequence.next(), key))
+    
+    def _abandon_prepared(self, show):
+        if show.prepared is not None:
+            self._abandoned.append(show.prepared)
+            show.prepared = None
     
     def add_show(self, key, token, source, schedule, leeway):
         with self._show_access:
             start_time, duration = self._get_next_time(schedule, leeway)
             
             if key not in self._shows:
-                self._shows[key] = self.ManagedShow(token, source, start_time,
-                    duration)
+                show = self._shows[key] = self.ManagedShow(token, source,
+                    start_time, duration)
+                self._source_keys.setdefault(key[0], set()).add(key)
+                self._push_start(key, start_time)
+                self._push_prepare(key, show)
                 self.fire('schedule', key=key, token=token,
                     start_time=start_time, duration=duration)
                 return True
@@ -47,17 +111,25 @@ class ShowManager(EventSource):
             same_time = (existing.duration == duration and
                 existing.start_time == start_time)
             identical = (existing.source == source and same_time)
+            existing.token = token
             if identical:
                 return False
             
             if not same_time:
+                self._push_start(key, start_time)
                 self.fire('schedule', key=key, token=token,
                     start_time=start_time, duration=duration)
             
-            existing.token = token
             existing.source = source
             existing.start_time = start_time
             existing.duration = duration
+            if not same_time:
+                existing.next_attempt = start_time
+            if existing.session is None:
+                # a session prepared for the old schedule or driver will not
+                # do for the new one
+                self._abandon_prepared(existing)
+                self._push_prepare(key, existing)
             
             if existing.session and existing.stop_time:
                 # if the new schedule increases the stop time of the session,
@@ -66,12 +138,27 @@ class ShowManager(EventSource):
                 new_stop_time = start_time + duration
                 if existing.stop_time < new_stop_time:
                     existing.stop_time = new_stop_time
+                    self._push_stop(key, new_stop_time)
             
             return True
     
-    def get_keys(self):
+    def get_keys(self, source_name=None):
+        """
+        Returns the keys of all managed shows, or only of those shows recorded
+        from the named source.
+        """
+        
         with self._show_access:
-            return set(self._shows.iterkeys())
+            if source_name is None:
+                return set(self._shows.iterkeys())
+            return set(self._source_keys.get(source_name, ()))
+    
+    def _forget(self, key):
+        del self._shows[key]
+        keys = self._source_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._source_keys[key[0]]
     
     def remove_show(self, key):
         with self._show_access:
@@ -81,20 +168,125 @@ class ShowManager(EventSource):
             show = self._shows[key]
             if not show.session:
                 # this show is not currently being recorded; just delete it
-                del self._shows[key]
+                self._abandon_prepared(show)
+                self._forget(key)
             else:
                 # clear out the record; it will be removed when the recording
                 # session is done
                 show.source = show.start_time = show.duration = None
             return show.token
     
+    def get_next_deadline(self):
+        """
+        Returns the earliest time at which a show may need to be prepared,
+        started or stopped, or None if nothing is scheduled.
+        """
+        
+        with self._show_access:
+            self._discard_stale_entries()
+            deadlines = [heap[0][0] for heap
+                in (self._prepares, self._starts, self._stops) if heap]
+            return min(deadlines) if deadlines else None
+    
+    def _start_entry_valid(self, entry):
+        show = self._shows.get(entry[2])
+        return (show is not None and show.session is None and
+            show.source is not None and show.next_attempt == entry[0])
+    
+    def _prepare_entry_valid(self, entry):
+        show = self._shows.get(entry[2])
+        return (show is not None and show.session is None and
+            show.prepared is None and show.get_prepare_time() == entry[0])
+    
+    def _stop_entry_valid(self, entry):
+        show = self._shows.get(entry[2])
+        return (show is not None and show.session is not None and
+            show.stop_time == entry[0])
+    
+    def _discard_stale_entries(self):
+        while self._starts and not self._start_entry_valid(self._starts[0]):
+            heapq.heappop(self._starts)
+        while self._stops and not self._stop_entry_valid(self._stops[0]):
+            heapq.heappop(self._stops)
+        while (self._prepares and
+            not self._prepare_entry_valid(self._prepares[0])):
+            heapq.heappop(self._prepares)
+    
+    def get_shows_to_prepare(self):
+        """
+        Returns (key, token, source, start time) for each show whose session
+        should now be prepared.
+        """
+        
+        now = time.time()
+        shows = []
+        
+        with self._show_access:
+            while self._prepares and self._prepares[0][0] <= now:
+                entry = heapq.heappop(self._prepares)
+                if not self._prepare_entry_valid(entry):
+                    continue
+                
+                s = self._shows[entry[2]]
+                if s.start_time > now:
+                    shows.append((entry[2], s.token, s.source, s.start_time))
+        
+        return shows
+    
+    def set_prepared(self, key, session):
+        with self._show_access:
+            show = self._shows.get(key)
+            if show is None or show.session is not None:
+                self._abandoned.append(session)
+                return False
+            show.prepared = session
+            return True
+    
+    def abandon_prepared_sessions(self):
+        with self._show_access:
+            for show in self._shows.itervalues():
+                self._abandon_prepared(show)
+    
+    def get_abandoned_sessions(self):
+        with self._show_access:
+            abandoned, self._abandoned = self._abandoned, []
+            return abandoned
+    
     def get_shows_to_start(self):
         now = time.time()
+        shows = []
+        seen = set()
         
         with self._show_access:
-            return [(key, s.token, s.source, s.duration - (now - s.start_time))
-                for key, s in self._shows.iteritems()
-                if s.session is None and s.source and now >= s.start_time]
+            while self._starts and self._starts[0][0] <= now:
+                entry = heapq.heappop(self._starts)
+                key = entry[2]
+                if key in seen or not self._start_entry_valid(entry):
+                    continue
+                
+                seen.add(key)
+                s = self._shows[key]
+                shows.append((key, s.token, s.source, s.start_time,
+                    s.duration - (now - s.start_time), s.prepared))
+        
+        return shows
+    
+    def defer_show(self, key, until):
+        """
+        Puts off starting a show that is due until the given time. The show's
+        schedule is unaffected; any session prepared for it is abandoned, and
+        a new one is made when the show is started.
+        """
+        
+        with self._show_access:
+            show = self._shows.get(key)
+            if show is None or show.session is not None:
+                return False
+            
+            self._abandon_prepared(show)
+            show.next_attempt = until
+            self._push_start(key, until)
+            return True
     
     def set_session(self, key, session, stop_time):
         with self._show_access:
@@ -104,7 +296,9 @@ class ShowManager(EventSource):
                 return False
             else:
                 show.session = session
+                show.prepared = None
                 show.stop_time = stop_time
+                self._push_stop(key, stop_time)
                 return True
     
     def get_sessions_to_stop(self):
@@ -112,14 +306,15 @@ class ShowManager(EventSource):
         now = time.time()
         
         with self._show_access:
-            for key, show in self._shows.iteritems():
-                if show.session is None or now < show.stop_time:
+            while self._stops and self._stops[0][0] <= now:
+                entry = heapq.heappop(self._stops)
+                if not self._stop_entry_valid(entry):
                     continue
                 
-                sessions.append((key, show.token, show.session))
-            
-            for session in sessions:
-                del self._shows[session[0]]
+                key = entry[2]
+                sessions.append((key, self._shows[key].token,
+                    self._shows[key].session))
+                self._forget(key)
         
         return sessions
     
@@ -131,13 +326,24 @@ class ShowManager(EventSource):
 
 class Recorder(EventSource):
     HOOKS = ("startup", "shutdown", "show_start", "show_error", "show_done",
-        "show_schedule", "show_save")
+        "show_schedule", "show_save", "show_segment", "show_warning")
     
     def __init__(self, config):
         super(Recorder, self).__init__()
         self._hooks = self._create_hook_invoker(config.options)
+        self._storage = self._create_storage_pipeline(config.options)
+        self._transcoder = self._create_transcoder(config.options)
+        self._journal = self._create_journal(config.options)
         self.__reload_lock = threading.RLock()
         self.__config_updated = threading.Event()
+        self.__wakeup = threading.Condition()
+        self.__active = False
+        self.__changed_sources = set()
+        self.configuration = None
+        self._storage_users = {}
+        self._session_storage = {}
+        self._retired_storage = {}
+        self._storage_lock = threading.Lock()
         self._manager = ShowManager()
         self._manager.observe('schedule', self._show_scheduled)
         
@@ -155,40 +361,166 @@ class Recorder(EventSource):
         
         return invoker
     
+    def _create_journal(self, options):
+        directory = options.get("journal")
+        if not directory:
+            return None
+        
+        journal = EventJournal(directory,
+            options.get("journal_segment_size", 1048576),
+            options.get("journal_sync_interval", 1.0))
+        # an audit trail must not lose events; if the journal falls that far
+        # behind, events are held up until it catches up
+        self.observe("*", journal.record, asynchronous=True,
+            queue_size=100000, overflow="block")
+        return journal
+    
+    def _create_storage_pipeline(self, options):
+        pipeline = StoragePipeline(options.get("storage_pool_size", 2))
+        pipeline.observe("save", self._recording_saved)
+        pipeline.observe("error", self._recording_error)
+        pipeline.observe("complete", self._recording_stored)
+        return pipeline
+    
+    def _create_transcoder(self, options):
+        transcoder = Transcoder(options.get("transcode_pool_size"),
+            options.get("ffmpeg", "ffmpeg"))
+        transcoder.observe("complete", self._recording_transcoded)
+        return transcoder
+    
     def apply_configuration(self, config):
+        """
+        Switches the recorder over to the given configuration. Only the parts
+        of the configuration that differ from the current one are touched.
+        """
+        
         with self.__reload_lock:
-            self._setup_hooks(config.hooks)
+            diff = ConfigurationDiff(self.configuration, config)
+            if diff.hooks_changed or diff.options_changed:
+                self._setup_hooks(config.hooks, config.options)
             
+            self._update_source_drivers(diff.changed_sources, config)
+            self.configuration = config
             self.storage = config.storage
             self.sources = config.sources
             self.options = config.options
+            get_spool().quota = config.options.get("spool_quota")
+            
+            for driver in diff.removed_storage:
+                self._retire_storage(driver)
+            for driver in diff.added_storage:
+                self._storage.observe_driver(driver)
             
-            self._observe_storage_drivers()
-            self.__config_updated.set()
+            if diff.changed_sources:
+                self.__changed_sources.update(diff.changed_sources)
+                self.__config_updated.set()
+        
+        # wake the recorder loop so that the new configuration takes effect
+        # immediately, rather than at the next scheduled deadline
+        with self.__wakeup:
+            self.__wakeup.notify()
+    
+    def _use_storage(self, drivers):
+        """
+        Records that something (a session or a recording being stored) will
+        be handing files to the given storage drivers.
+        """
+        
+        with self._storage_lock:
+            for driver in drivers:
+                entry = self._storage_users.setdefault(id(driver),
+                    [driver, 0])
+                entry[1] += 1
+    
+    def _release_storage(self, drivers):
+        """
+        Records that something is done with the given storage drivers, and
+        shuts down any driver that has been removed from the configuration
+        once nothing is using it any longer.
+        """
+        
+        idle = []
+        with self._storage_lock:
+            for driver in drivers:
+                entry = self._storage_users.get(id(driver))
+                if entry is None:
+                    continue
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._storage_users[id(driver)]
+                    if self._retired_storage.pop(id(driver), None):
+                        idle.append(driver)
+        
+        for driver in idle:
+            driver.shutdown()
+    
+    def _retire_storage(self, driver):
+        """
+        Shuts down a storage driver that has been removed from the
+        configuration, once the sessions that were started while it was
+        configured have finished with it.
+        """
+        
+        if not hasattr(driver, 'shutdown'):
+            return
+        with self._storage_lock:
+            if id(driver) in self._storage_users:
+                self._retired_storage[id(driver)] = driver
+                return
+        driver.shutdown()
+    
+    def _update_source_drivers(self, source_names, config):
+        """
+        Activates the drivers of the named sources in the given
+        configuration, and shuts down those they replace. New drivers are
+        activated first, so that anything the old and new drivers share
+        (such as a stream's ring buffer) is kept.
+        """
+        
+        old_sources = self.sources if self.configuration else {}
+        replaced = []
+        for name in source_names:
+            old, new = old_sources.get(name), config.sources.get(name)
+            if old and new and old.driver is new.driver:
+                continue
+            if new and hasattr(new.driver, 'activate'):
+                new.driver.activate()
+            if old:
+                replaced.append(old.driver)
+        
+        for driver in replaced:
+            if hasattr(driver, 'shutdown'):
+                driver.shutdown()
     
-    def _setup_hooks(self, hooks):
+    def _setup_hooks(self, hooks, options):
         """Registers the given hooks on this recorder."""
         invoker = self._hooks
         
         invoker.clear()
+        invoker.default_concurrency = options.get("hook_concurrency", 1)
+        invoker.default_timeout = options.get("hook_timeout")
         for name, implementations in hooks.iteritems():
             try:
                 source = implementations.iteritems()
             except AttributeError:
-                source = (("%s:%d" % (name, i + 1), implementations[i])
-                    for i in enumerate(implementations))
+                source = (("%s:%d" % (name, i + 1), impl)
+                    for i, impl in enumerate(implementations))
             
             for description, impl in source:
-                impl = get_hook(impl, [])
-                invoker.register_hook(name, impl, description)
-    
-    def _observe_storage_drivers(self):
-        for driver in self.storage.itervalues():
-            driver.observe("save", self._recording_saved)
-            driver.observe("error", self._recording_error)
+                settings = {}
+                if isinstance(impl, dict):
+                    hook = get_hook(impl.get("path"), [],
+                        bool(impl.get("persistent", False)),
+                        int(impl.get("max_in_flight", 1)),
+                        impl.get("processes"))
+                    for setting in ("concurrency", "timeout", "batch_size",
+                        "batch_delay"):
+                        settings[setting] = impl.get(setting)
+                else:
+                    hook = get_hook(impl, [])
+                invoker.register_hook(name, hook, description, **settings)
     
     def start(self):
-        self.__shutdown_condition = threading.Condition()
         self.__active = True
         
         self._run()
@@ -198,32 +530,51 @@ class Recorder(EventSource):
             raise RuntimeError("cannot stop; Recorder is not running")
         
         self.__active = False
-        with self.__shutdown_condition:
-            self.__shutdown_condition.notify()
+        with self.__wakeup:
+            self.__wakeup.notify()
         
+        # drivers still needed by recordings in progress are shut down once
+        # those recordings have been stored
         for driver in self.storage.itervalues():
-            if hasattr(driver, 'shutdown'):
-                driver.shutdown()
+            self._retire_storage(driver)
+        for source in self.sources.itervalues():
+            if hasattr(source.driver, 'shutdown'):
+                source.driver.shutdown()
     
     def _run(self):
         self.fire("startup")
-        with self.__shutdown_condition:
+        with self.__wakeup:
             while self.__active:
-                check_interval = self.options.get("check_interval", 1.0)
                 with self.__reload_lock:
                     self._tick()
-                self.__shutdown_condition.wait(check_interval)
+                
+                delay = self._get_sleep_time()
+                if delay > 0:
+                    self.__wakeup.wait(delay)
         self._shutdown()
+    
+    def _get_sleep_time(self):
+        """
+        Returns the number of seconds the recorder loop can sleep before it
+        needs to start or stop a show. The `check_interval` option puts an
+        upper bound on the sleep as a guard against changes to the clock.
+        """
         
+        if self.__config_updated.isSet():
+            return 0
+        
+        max_sleep = self.options.get("check_interval", 60.0)
+        deadline = self._manager.get_next_deadline()
+        if deadline is None:
+            return max_sleep
+        return min(max_sleep, max(0, deadline - time.time()))
+    
     def _shutdown(self):
         # Shut down the hook invoker threads; they will finish any current
         # work and then terminate. (The process will not exit until the invoker
         # threads stop; they are not daemon threads.)
         self._hooks.stop()
         
-        monitor = ProcessMonitor.get_instance()
-        monitor.observe("empty", self._subprocesses_all_exited)
-        
         # Stop any recording tasks that are in progress. Shutdown will continue
         # when all recording subprocesses exit.
         for key, session in self._manager.get_all_sessions():
@@ -231,27 +582,69 @@ class Recorder(EventSource):
                 session.stop()
             except RuntimeError:
                 pass
+        
+        # Sessions prepared for shows that have not started yet will never
+        # record; let go of them, and of the storage they would have used.
+        self._manager.abandon_prepared_sessions()
+        for session in self._manager.get_abandoned_sessions():
+            session.cancel()
+            self._session_ended(session)
+        
+        ProcessMonitor.get_instance().when_empty(self._subprocesses_all_exited)
     
     def _subprocesses_all_exited(self):
         ProcessMonitor.get_instance().halt()
+        self._transcoder.when_idle(self._transcoding_finished)
+    
+    def _transcoding_finished(self):
+        # storage can only be shut down once every recording that is being
+        # converted has been handed to it
+        self._transcoder.shutdown()
+        self._storage.shutdown()
         self.fire("shutdown")
     
     def _tick(self):
         if self.__config_updated.isSet():
-            self._update_manager()
+            self._update_manager(self.__changed_sources)
+            self.__changed_sources = set()
             self.__config_updated.clear()
         
+        prepares = self._manager.get_shows_to_prepare()
+        for key, token, driver, start_time in prepares:
+            self._prepare_session(key, token, driver, start_time)
+        for session in self._manager.get_abandoned_sessions():
+            session.cancel()
+            self._session_ended(session)
+        
         now = time.time()
-        for key, token, driver, duration in self._manager.get_shows_to_start():
+        spool = get_spool()
+        starts = self._manager.get_shows_to_start()
+        for key, token, driver, start_time, duration, session in starts:
             stop_time = now + duration
             
             source, show = token
-            session = driver.spawn(key[1])
+            if duration <= 0:
+                # the show ended while it was waiting to start
+                self._manager.remove_show(key)
+                self._reschedule_show(*key)
+                continue
+            elif not spool.admit():
+                self.fire("show_error", source=source, show=show,
+                    error="not enough room in the spool to start recording")
+                retry = self.options.get("spool_retry_interval", 30)
+                self._manager.defer_show(key, now + min(retry, duration))
+                continue
+            
+            if session is None:
+                session = driver.spawn(key[1])
+                self._observe_session_events(source, show, session)
+            if start_time < now and hasattr(session, "backfill"):
+                # starting late; pick up what the source kept since then
+                session.backfill(start_time)
             can_stop = session.can_stop_automatically(duration)
             if can_stop:
                 stop_time += 3
             
-            self._observe_session_events(source, show, session)
             session.start(duration if can_stop else None)
             self._manager.set_session(key, session, stop_time)
             
@@ -263,42 +656,135 @@ class Recorder(EventSource):
             
             self._reschedule_show(*key)
     
-    def _update_manager(self):
-        existing_keys = self._manager.get_keys()
-        updated_keys = set()
+    def _prepare_session(self, key, token, driver, start_time):
+        """
+        Creates the session for a show ahead of its start, and has it get
+        ready to begin recording at the given start time.
+        """
         
-        for source_name, source in self.sources.iteritems():
-            for show in source.shows:
+        source, show = token
+        session = driver.spawn(key[1])
+        try:
+            session.prepare(start_time)
+        except Exception, e:
+            # the show will be started the usual way when it is due
+            self.fire("show_error", source=source, show=show,
+                error="failed to prepare recording: %s" % e)
+            return
+        
+        self._observe_session_events(source, show, session)
+        self._manager.set_prepared(key, session)
+    
+    def _update_manager(self, source_names):
+        """
+        Brings the show manager up to date with the shows of the named
+        sources.
+        """
+        
+        leeway = self.options.get('leeway', 0)
+        sources = [self.sources[name] for name in source_names
+            if name in self.sources]
+        replace = not (set(self.sources.iterkeys()) - set(source_names))
+        self._manager.calendar.prime((show.schedule for source in sources
+            for show in source.shows), leeway, replace)
+        
+        for source_name in source_names:
+            existing_keys = self._manager.get_keys(source_name)
+            updated_keys = set()
+            source = self.sources.get(source_name)
+            
+            for show in (source.shows if source else ()):
                 key = (source_name, show.name)
                 updated_keys.add(key)
                 token = (source, show)
                 
                 changed = self._manager.add_show(key, token, source.driver,
-                    show.schedule, self.options.get('leeway', 0))
+                    show.schedule, leeway)
                 if changed:
                     event = ('show_update' if key in existing_keys
                         else 'show_add')
                     self.fire(event, source=source, show=show)
-        
-        keys_to_remove = (existing_keys - updated_keys)
-        for key in keys_to_remove:
-            token = self._manager.remove_show(key)
-            if token:
-                self.fire('show_remove', source=token[0], show=token[1])
+            
+            keys_to_remove = (existing_keys - updated_keys)
+            for key in keys_to_remove:
+                token = self._manager.remove_show(key)
+                if token:
+                    self.fire('show_remove', source=token[0], show=token[1])
     
     def _observe_session_events(self, source, show, session):
+        analyses = []
+        
+        # the session's recordings go to the storage configured now, even
+        # if the configuration is reloaded while it is recording
+        self._use_storage(source.storage)
+        with self._storage_lock:
+            self._session_storage[id(session)] = list(source.storage)
+        
         def started(session, **kwargs):
             self.fire("show_start", source=source, show=show)
+            analysis = self._start_analysis(source, show, session)
+            if analysis:
+                analyses.append(analysis)
+        def ended():
+            for analysis in analyses:
+                analysis.finish()
         def error(session, error):
+            ended()
             self.fire("show_error", source=source, show=show, error=error)
+            self._session_ended(session)
+        def segment_finished(session, filename, index):
+            # segments are stored while the rest of the show is recorded
+            self.fire("show_segment", source=source, show=show,
+                filename=filename, index=index)
+            self._store_recording(source, show, filename)
         def finished(session, filename):
+            ended()
             self.fire("show_done", source=source, show=show, filename=filename)
-            self._store_recording(source, show, filename)
+            # a segmented recording's manifest is stored as it is
+            self._store_recording(source, show, filename,
+                not getattr(session, "segments", None))
+            self._session_ended(session)
         
         session.observe("start", started)
         session.observe("error", error)
+        session.observe("segment", segment_finished)
         session.observe("done", finished)
     
+    def _session_ended(self, session):
+        with self._storage_lock:
+            drivers = self._session_storage.pop(id(session), ())
+        self._release_storage(drivers)
+    
+    def _start_analysis(self, source, show, session):
+        """
+        Starts listening to a session's recording for dead air and clipping,
+        if the `analysis` option asks for it.
+        """
+        
+        # an empty mapping means the default settings
+        settings = self.options.get("analysis")
+        if settings is None:
+            return None
+        
+        settings = dict(settings)
+        poll_interval = settings.pop("poll_interval", 5.0)
+        if "clip_count" in settings:
+            settings["clip_count"] = int(settings["clip_count"])
+        analysis = RecordingAnalysis(session, settings, poll_interval,
+            self.options.get("ffmpeg", "ffmpeg"))
+        
+        def warning(kind, start, end):
+            self.fire("show_warning", source=source, show=show, kind=kind,
+                start=start, end=end, warning=describe_problem(kind, start,
+                end))
+        def failed(error):
+            self.fire("show_error", source=source, show=show, error=error)
+        
+        analysis.observe("warning", warning)
+        analysis.observe("error", failed)
+        analysis.start()
+        return analysis
+    
     def _show_scheduled(self, key, token, start_time, duration):
         source, show = token
         self.fire("show_schedule", source=source, show=show,
@@ -322,10 +808,52 @@ class Recorder(EventSource):
         
         return False
     
-    def _store_recording(self, source, show, temp_file):
+    def _store_recording(self, source, show, temp_file, transcode=True):
+        """
+        Saves a recording to its source's storage locations. Locations that
+        want another encoding are given the recording once the transcoder
+        has converted it.
+        """
+        
+        targets = {}
         for driver in source.storage:
-            driver.save(source, show, temp_file)
+            encoding = getattr(driver, "encoding", None) if transcode else None
+            targets.setdefault(encoding, []).append(driver)
+        unconverted = targets.pop(None, [])
+        
+        # the transcoder holds on to the original until it is done with it
+        get_spool().retain(temp_file, len(unconverted) + bool(targets))
+        if unconverted or not targets:
+            self._store(source, show, temp_file, unconverted)
+        if targets:
+            self._use_storage(driver for drivers in targets.itervalues()
+                for driver in drivers)
+            self._transcoder.transcode(source, show, temp_file, targets)
+    
+    def _store(self, source, show, file_path, drivers):
+        self._use_storage(drivers)
+        self._storage.store(source, show, file_path, drivers)
+    
+    def _recording_transcoded(self, job):
+        if job.error:
+            # store the recording as it is rather than not at all
+            self.fire("show_error", source=job.source, show=job.show,
+                error="failed to convert recording: %s" % job.error)
         
+        spool = get_spool()
+        for encoding, drivers in job.targets.iteritems():
+            file_path = job.outputs.get(encoding, job.file_path)
+            spool.retain(file_path, len(drivers))
+            self._store(job.source, job.show, file_path, drivers)
+        spool.release(job.file_path)
+        self._release_storage(driver for drivers in job.targets.itervalues()
+            for driver in drivers)
+    
+    def _recording_stored(self, job):
+        get_spool().release(job.file_path, job.succeeded(),
+            len(job.locations) + len(job.errors))
+        self._release_storage(job.locations.keys() + job.errors.keys())
+    
     def _recording_saved(self, source, show, location):
         self.fire("show_save", source=source, show=show, location=location)
     
@@ -335,13 +863,82 @@ class Recorder(EventSource):
 class HookInvoker(EventSource):
     """
     Manages hook invocations in a pool of threads.
+    
+    Each registered hook has its own queue of pending invocations, a limit on
+    how many of its invocations may run at once, and an optional timeout.
+    Workers take invocations from the hooks with pending work in turn, so
+    that a slow or busy hook cannot starve the others. Script hooks that run
+    past their timeout are killed; a Python hook that does so is abandoned
+    (it keeps its place against its hook's concurrency limit until it
+    returns), and the worker moves on.
+    
+    A hook can also be given its events in batches. Its events are held
+    until `batch_size` of them have arrived or the first of them has waited
+    `batch_delay` seconds, and the hook is then called once with the list of
+    events as its `events` argument. For hooks that report the state of a
+    show (see `COALESCED_HOOKS`), a held event about the same show as a newer
+    one is dropped in favor of the newer one; every other event is delivered.
     """
     
     THREAD_NAME_PATTERN = "HookInvocationThread-%d"
     
-    def __init__(self, pool_size):
+    DEFAULT_BATCH_DELAY = 1.0
+    
+    # hooks whose events about a show supersede the earlier ones
+    COALESCED_HOOKS = frozenset(("show_schedule", "show_add", "show_update",
+        "show_remove"))
+    
+    class Registration(object):
+        def __init__(self, hook, description, concurrency, timeout,
+            batch_size=None, batch_delay=None, coalesce=False):
+            self.hook = hook
+            self.description = description
+            self.concurrency = max(1, concurrency)
+            self.timeout = timeout
+            self.batch_size = batch_size
+            self.batch_delay = batch_delay
+            self.coalesce = coalesce
+            self.batch = OrderedDict()
+            self.batch_started = None
+            self.pending = deque()
+            self.running = 0
+            self.scheduled = False
+            self.completed = 0
+            self.failed = 0
+            self.timed_out = 0
+            self.total_latency = 0.0
+            self.max_latency = 0.0
+        
+        def is_batched(self):
+            return self.batch_delay is not None
+        
+        def is_runnable(self):
+            return self.pending and self.running < self.concurrency
+        
+        def get_batch_deadline(self):
+            if self.batch_started is None:
+                return None
+            return self.batch_started + self.batch_delay
+        
+        def get_statistics(self):
+            finished = self.completed + self.failed
+            return {
+                "queued": len(self.pending),
+                "batched": len(self.batch),
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+                "mean_latency": (self.total_latency / finished
+                    if finished else None),
+                "max_latency": self.max_latency
+            }
+    
+    def __init__(self, pool_size, default_concurrency=1, default_timeout=None):
         super(HookInvoker, self).__init__()
         self.__active = True
+        self.default_concurrency = default_concurrency
+        self.default_timeout = default_timeout
         
         self._create_hook_dict()
         self._create_workers(pool_size)
@@ -351,6 +948,7 @@ class HookInvoker(EventSource):
             self.__active = False
             with self.__task_available:
                 self.__task_available.notifyAll()
+            self.clear()
     
     def create_hook(self, name):
         """
@@ -362,37 +960,77 @@ class HookInvoker(EventSource):
                     name)
             hooks[name] = []
     
-    def register_hook(self, name, hook, description=None):
+    def register_hook(self, name, hook, description=None, concurrency=None,
+        timeout=None, batch_size=None, batch_delay=None):
         """
         Causes the given hook to be called when hook events for the given
-        name are generated.
+        name are generated. At most `concurrency` invocations of the hook
+        will run at once, and each is given `timeout` seconds to finish; the
+        invoker's defaults are used for any that are not given.
+        
+        If `batch_size` or `batch_delay` is given, the hook is given its
+        events in batches.
         """
+        if concurrency is None:
+            concurrency = self.default_concurrency
+        if timeout is None:
+            timeout = self.default_timeout
+        if batch_size is not None and batch_delay is None:
+            batch_delay = self.DEFAULT_BATCH_DELAY
+        
+        registration = self.Registration(hook,
+            "%s/%s" % (name, description), concurrency, timeout,
+            batch_size, batch_delay, name in self.COALESCED_HOOKS)
         with self._get_all_hooks() as hooks:
             try:
-                hooks[name].append((hook, description))
+                hooks[name].append(registration)
             except KeyError:
                 raise ValueError('no hook named %r has been registered' % name)
     
     def clear(self):
+        removed = []
         with self._get_all_hooks() as hooks:
             for name in hooks.iterkeys():
                 while len(hooks[name]) > 0:
-                    hooks[name].pop()
+                    removed.append(hooks[name].pop())
+        
+        # release anything (such as worker processes) held by the hooks
+        for registration in removed:
+            if hasattr(registration.hook, "close"):
+                registration.hook.close()
     
     def invoke(self, hook_name, **arguments):
         hooks = self._get_hooks(hook_name)
         if len(hooks) <= 0:
             return
         
-        for hook, description in hooks:
-            full_desc = "%s/%s" % (hook_name, description)
-            self.__task_queue.put((hook, full_desc, arguments))
+        # script hooks share a single encoding of the arguments
+        payload = HookPayload(arguments)
+        now = time.time()
+        with self.__task_available:
+            for registration in hooks:
+                if registration.is_batched():
+                    self._add_to_batch(registration, now, arguments)
+                else:
+                    registration.pending.append((now, payload))
+                    self._schedule(registration)
+            self.__task_available.notify(len(hooks))
+    
+    def get_statistics(self):
+        """
+        Returns a dictionary mapping the description of each registered hook
+        to a dictionary of its queue depth, running, finished and timed-out
+        invocation counts, and mean and maximum latency (from invocation to
+        completion, in seconds).
+        """
+        
+        with self._get_all_hooks() as hooks:
+            registrations = [r for hook_list in hooks.itervalues()
+                for r in hook_list]
         
         with self.__task_available:
-            if len(hooks) == 1:
-                self.__task_available.notify()
-            else:
-                self.__task_available.notifyAll()
+            return dict((r.description, r.get_statistics())
+                for r in registrations)
     
     def observe_events(self, event_source):
         """
@@ -424,8 +1062,12 @@ class HookInvoker(EventSource):
         self.__hooks_lock = threading.RLock()
     
     def _create_workers(self, pool_size):
-        self.__task_available = threading.Condition()
-        self.__task_queue = Queue(0)
+        # __runnable holds the registrations with pending invocations, in the
+        # order in which workers will serve them
+        self.__task_available = threading.Condition(threading.Lock())
+        self.__runnable = deque()
+        self.__batching = set()
+        self.__event_counter = itertools.count()
         self.__workers = []
         
         for i in xrange(pool_size):
@@ -447,19 +1089,161 @@ class HookInvoker(EventSource):
                 raise ValueError('no hook named %r has been registered' %
                     hook_name)
     
+    def _schedule(self, registration):
+        # must be called with __task_available held
+        if registration.pending and not registration.scheduled:
+            registration.scheduled = True
+            self.__runnable.append(registration)
+    
+    def _add_to_batch(self, registration, now, arguments):
+        # must be called with __task_available held
+        key = None
+        if registration.coalesce:
+            try:
+                key = (arguments["source"].name, arguments["show"].name)
+            except (KeyError, AttributeError):
+                pass
+        if key is None:
+            key = self.__event_counter.next()
+        
+        batch = registration.batch
+        batch.pop(key, None)
+        batch[key] = arguments
+        if registration.batch_started is None:
+            registration.batch_started = now
+            self.__batching.add(registration)
+        
+        if registration.batch_size and len(batch) >= registration.batch_size:
+            self._flush_batch(registration)
+    
+    def _flush_batch(self, registration):
+        # must be called with __task_available held
+        events = registration.batch.values()
+        registration.pending.append((registration.batch_started,
+            HookPayload({"events": events})))
+        registration.batch.clear()
+        registration.batch_started = None
+        self.__batching.discard(registration)
+        self._schedule(registration)
+    
+    def _flush_due_batches(self):
+        # must be called with __task_available held; returns the time at
+        # which the next batch will be due, or None if none are waiting
+        now = time.time()
+        next_deadline = None
+        for registration in list(self.__batching):
+            deadline = registration.get_batch_deadline()
+            if deadline <= now:
+                self._flush_batch(registration)
+            elif next_deadline is None or deadline < next_deadline:
+                next_deadline = deadline
+        return next_deadline
+    
+    def _next_task(self):
+        # must be called with __task_available held; returns None if no hook
+        # can run right now
+        for i in xrange(len(self.__runnable)):
+            registration = self.__runnable.popleft()
+            if not registration.pending:
+                registration.scheduled = False
+                continue
+            
+            # move the hook to the back of the line, whether or not it can
+            # run now, so that the others get their turns first
+            self.__runnable.append(registration)
+            if registration.is_runnable():
+                registration.running += 1
+                return (registration,) + registration.pending.popleft()
+        return None
+    
     def _run_hooks(self):
-        while self.__active:
+        while True:
             with self.__task_available:
-                while self.__task_queue.empty():
+                while True:
                     if not self.__active:
                         return
-                    else:
+                    next_deadline = self._flush_due_batches()
+                    task = self._next_task()
+                    if task:
+                        break
+                    if next_deadline is None:
                         self.__task_available.wait()
-                task = self.__task_queue.get()
+                    else:
+                        self.__task_available.wait(max(0,
+                            next_deadline - time.time()))
             
-            hook, description, arguments = task
+            registration, queued_at, payload = task
+            self._call_hook(registration, queued_at, payload)
+    
+    def _call_hook(self, registration, queued_at, payload):
+        hook, timeout = registration.hook, registration.timeout
+        
+        if hasattr(hook, "invoke") or not timeout:
             try:
-                hook(**arguments)
+                if hasattr(hook, "invoke"):
+                    hook.invoke(payload, timeout)
+                else:
+                    hook(**payload.arguments)
             except Exception, e:
-                self.fire("failure", description=description, error=e)
-
+                self._hook_finished(registration, queued_at, e)
+            else:
+                self._hook_finished(registration, queued_at)
+            return
+        
+        # Python hooks cannot be killed, so run them in a thread of their own
+        # that can be abandoned if the hook does not finish in time
+        outcome = {}
+        def run():
+            try:
+                hook(**payload.arguments)
+            except Exception, e:
+                outcome["error"] = e
+            
+            with self.__task_available:
+                reported = outcome.setdefault("reported", False)
+            if reported:
+                self._hook_finished(registration, queued_at, report=False)
+        
+        thread = threading.Thread(target=run,
+            name="HookThread-%s" % registration.description)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(timeout)
+        
+        with self.__task_available:
+            abandoned = outcome.setdefault("reported", thread.isAlive())
+        if abandoned:
+            self.fire("failure", description=registration.description,
+                error=HookTimeoutError("hook timed out after %s seconds" %
+                    timeout))
+            latency = time.time() - queued_at
+            with self.__task_available:
+                registration.failed += 1
+                registration.timed_out += 1
+                registration.total_latency += latency
+                registration.max_latency = max(registration.max_latency,
+                    latency)
+        else:
+            self._hook_finished(registration, queued_at, outcome.get("error"))
+    
+    def _hook_finished(self, registration, queued_at, error=None,
+        report=True):
+        latency = time.time() - queued_at
+        with self.__task_available:
+            registration.running -= 1
+            if report:
+                if error is None:
+                    registration.completed += 1
+                else:
+                    registration.failed += 1
+                    if isinstance(error, HookTimeoutError):
+                        registration.timed_out += 1
+                registration.total_latency += latency
+                registration.max_latency = max(registration.max_latency,
+                    latency)
+            self._schedule(registration)
+            self.__task_available.notify()
+        
+        if report and error is not None:
+            self.fire("failure", description=registration.description,
+                error=error)
@@ -4,8 +4,11 @@
 Handling of show schedules.
 """
 
+from __future__ import with_statement
+
 import re
 import time
+import threading
 from permanence.config import ConfigurationError
 from permanence.hook import add_json_serializer
 
@@ -17,11 +20,103 @@ def get_schedule(kind, definition):
     
     return implementation.from_config(definition)
 
+class ScheduleCalendar(object):
+    """
+    Computes the upcoming occurrences of many schedules at once.
+    
+    The local midnights of the days within the calendar's horizon are worked
+    out once per batch and shared by every schedule, and identical schedules
+    are only computed once. The occurrences found for each schedule are cached
+    until they have all passed.
+    
+    Schedules that can take advantage of this provide a
+    `get_occurrences(days, leeway)` method, where `days` is a list of
+    `(midnight, weekday)` pairs; other schedules are asked for their
+    `get_next_time(leeway)` instead.
+    """
+    
+    def __init__(self, horizon=8):
+        self.horizon = horizon
+        self._days = (None, [])
+        self._cache = {}
+        self._lock = threading.Lock()
+    
+    def prime(self, schedules, leeway, replace=False):
+        """
+        Computes the occurrences of all of the given schedules. If `replace`
+        is true, anything previously cached for other schedules is discarded.
+        """
+        
+        now = time.time()
+        with self._lock:
+            days = self._get_days(now)
+            cache = {} if replace else dict(self._cache)
+            computed = set()
+            for schedule in schedules:
+                key = (schedule, leeway)
+                if key not in computed:
+                    cache[key] = self._compute(schedule, leeway, days, now)
+                    computed.add(key)
+            self._cache = cache
+    
+    def get_occurrences(self, schedule, leeway, count=None):
+        """
+        Returns a list of upcoming `(start_time, duration)` pairs for the given
+        schedule, soonest first. An occurrence that has already started but
+        not yet finished is included.
+        """
+        
+        now = time.time()
+        key = (schedule, leeway)
+        with self._lock:
+            occurrences = self._cache.get(key)
+            if occurrences:
+                while occurrences and sum(occurrences[0]) <= now:
+                    occurrences.pop(0)
+            if not occurrences:
+                occurrences = self._compute(schedule, leeway,
+                    self._get_days(now), now)
+                self._cache[key] = occurrences
+            return list(occurrences[:count])
+    
+    def get_next_time(self, schedule, leeway):
+        occurrences = self.get_occurrences(schedule, leeway, 1)
+        return occurrences[0] if occurrences else None
+    
+    def _compute(self, schedule, leeway, days, now):
+        if hasattr(schedule, "get_occurrences"):
+            return [occurrence for occurrence
+                in schedule.get_occurrences(days, leeway)
+                if sum(occurrence) > now]
+        
+        next_time = schedule.get_next_time(leeway)
+        return [next_time] if next_time else []
+    
+    def _get_days(self, now):
+        today = time.localtime(now)[:3]
+        if self._days[0] != today:
+            days = []
+            for offset in xrange(self.horizon):
+                midnight = time.mktime((today[0], today[1], today[2] + offset,
+                    0, 0, 0, 0, 0, -1))
+                days.append((midnight, time.localtime(midnight).tm_wday))
+            self._days = (today, days)
+        return self._days[1]
+
 class WeeklySchedule(object):
     def __init__(self, weekdays, start_time, duration):
         self.weekdays = tuple(weekdays)
         self.start_time = start_time
         self.duration = duration
+        self._weekday_set = frozenset(self.weekdays)
+    
+    def get_occurrences(self, days, leeway):
+        start_time = self.start_time - leeway
+        duration = self.duration + (leeway * 2)
+        weekdays = self._weekday_set
+        
+        return [(midnight + start_time, duration)
+            for midnight, weekday in days if weekday in weekdays]
     
     def get_next_time(self, leeway):
         now = time.localtime()
@@ -0,0 +1,758 @@
+# encoding: utf-8
+
+"""
+Implements a source driver that records HTTP (including Icecast and
+SHOUTcast) streams itself, rather than through an external program.
+
+Every stream being recorded is read by a single I/O thread (the reactor),
+which waits on all of their sockets at once and writes what arrives straight
+to the recordings' files in the spool. A stream that fails or is cut off is
+reconnected, with exponential backoff, until the recording is over; redirects
+are followed. Only plain HTTP streams are supported.
+
+Recordings of the same stream that overlap (such as back-to-back shows whose
+leeway makes them overlap) share a single connection: each recording takes
+what arrives from the shared connection between its own start and end.
+
+If the driver is given a `segment_length` (in seconds), each recording is
+written as a series of files of about that length instead of as one file.
+Each segment is announced with a "segment" event as soon as it is complete,
+so that it can be stored while the recording goes on. When the recording
+ends, "done" names a JSON manifest listing the segments in order. Each
+segment is listed by its suffix (such as ".part001.mp3"), which takes the
+place of the manifest's ".manifest.json" in the segment's name, both in the
+spool and wherever storage drivers save them.
+
+If the driver is given a `ring_size`, its stream is captured all the time
+(while the driver is in use) into a ring buffer of that many bytes in the
+spool (see `permanence.ring`). A recording that starts after its show was
+scheduled to begin then starts with what the ring holds from the scheduled
+start, so a show that is added late, or whose recording could not start on
+time, loses as little as possible.
+"""
+
+from __future__ import with_statement
+
+from permanence.config import ConfigurationError, parse_size
+from permanence.event import EventSource
+from permanence.ring import RingBuffer
+from permanence.temp import get_spool
+from urlparse import urlparse, urljoin
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import itertools
+import threading
+import traceback
+import random
+import select
+import socket
+import heapq
+import errno
+import time
+import sys
+import os
+import re
+
+CONTENT_TYPE_EXTENSIONS = {
+    "audio/mpeg": ".mp3",
+    "audio/mp3": ".mp3",
+    "audio/aac": ".aac",
+    "audio/aacp": ".aac",
+    "audio/x-aac": ".aac",
+    "application/ogg": ".ogg",
+    "audio/ogg": ".ogg",
+    "audio/flac": ".flac",
+    "audio/x-flac": ".flac",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav"
+}
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+MAX_HEADER_SIZE = 65536
+READ_SIZE = 65536
+
+class StreamReactor(object):
+    """
+    Runs the I/O for all streams on one thread. Other threads hand work to
+    the reactor with `call_soon` and `call_later`; everything else must only
+    be used from the reactor thread.
+    """
+    
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._pending = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = None
+    
+    @classmethod
+    def get_instance(cls):
+        if not hasattr(cls, "_global_instance"):
+            cls._global_instance = cls()
+        return cls._global_instance
+    
+    def call_soon(self, function, *args):
+        """Runs the given function on the reactor thread."""
+        
+        with self._lock:
+            self._pending.append((function, args))
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                    name="StreamReactorThread")
+                self._thread.setDaemon(True)
+                self._thread.start()
+        os.write(self._wake_write, "x")
+    
+    def call_later(self, delay, function, *args):
+        """
+        Runs the given function on the reactor thread after the given number
+        of seconds. Must be called from the reactor thread; returns a timer
+        that can be given to `cancel`.
+        """
+        
+        timer = [time.time() + delay, self._sequence.next(), function, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+    
+    def cancel(self, timer):
+        if timer:
+            timer[2] = None
+    
+    def add_reader(self, sock, handler):
+        self._readers[sock.fileno()] = (sock, handler)
+    
+    def add_writer(self, sock, handler):
+        self._writers[sock.fileno()] = (sock, handler)
+    
+    def remove(self, sock):
+        try:
+            fd = sock.fileno()
+        except socket.error:
+            return
+        self._readers.pop(fd, None)
+        self._writers.pop(fd, None)
+    
+    def _get_timeout(self):
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time.time())
+    
+    def _run(self):
+        while True:
+            readers = [self._wake_read] + self._readers.keys()
+            try:
+                readable, writable, _ = select.select(readers,
+                    self._writers.keys(), [], self._get_timeout())
+            except (select.error, IOError, OSError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            
+            for fd in readable:
+                if fd == self._wake_read:
+                    os.read(fd, 4096)
+                elif fd in self._readers:
+                    self._dispatch(self._readers[fd][1])
+            for fd in writable:
+                if fd in self._writers:
+                    self._dispatch(self._writers[fd][1])
+            
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                when, sequence, function, args = heapq.heappop(self._timers)
+                if function is not None:
+                    self._dispatch(function, *args)
+            
+            with self._lock:
+                pending, self._pending = self._pending, []
+            for function, args in pending:
+                self._dispatch(function, *args)
+    
+    def _dispatch(self, function, *args):
+        try:
+            function(*args)
+        except Exception:
+            traceback.print_exc()
+
+class StreamCapture(object):
+    """
+    A connection to a stream, which is reconnected whenever it is lost for as
+    long as anything is receiving from the capture. Data from the stream is
+    given to each of the capture's receivers as it arrives, as
+    receiver(data, content_type). Must only be used from the reactor thread.
+    """
+    
+    # the capture of each stream that is being recorded, by URL
+    _shared = {}
+    
+    def __init__(self, driver):
+        self.driver = driver
+        self.reactor = StreamReactor.get_instance()
+        self._receivers = []
+        self.content_type = None
+        self.last_error = None
+        self._socket = None
+        self._timer = None
+        self._closed = False
+        self._failures = 0
+        self._generation = 0
+    
+    @classmethod
+    def attach(cls, driver, receiver):
+        """
+        Starts giving data from the driver's stream to the given receiver,
+        connecting to the stream if it is not already being captured.
+        Returns the capture.
+        """
+        
+        capture = cls._shared.get(driver.stream)
+        if capture is None:
+            capture = cls._shared[driver.stream] = cls(driver)
+            capture.open()
+        capture._receivers.append(receiver)
+        return capture
+    
+    def detach(self, receiver):
+        """
+        Stops giving data to the given receiver, and closes the capture if
+        nothing else is receiving from it.
+        """
+        
+        if receiver in self._receivers:
+            self._receivers.remove(receiver)
+        if not self._receivers:
+            self.close()
+    
+    def open(self):
+        self._connect(self.driver.stream, 0)
+    
+    def close(self):
+        self._closed = True
+        self.reactor.cancel(self._timer)
+        self._disconnect()
+        if self._shared.get(self.driver.stream) is self:
+            del self._shared[self.driver.stream]
+    
+    def _connect(self, url, redirects):
+        if self._closed:
+            return
+        
+        parts = urlparse(url)
+        if parts.scheme != "http" or not parts.hostname:
+            self._failed("cannot record from %r" % url, permanent=True)
+            return
+        
+        # name lookups block, so they are done off of the reactor thread
+        self._generation += 1
+        generation = self._generation
+        def look_up():
+            try:
+                addresses = socket.getaddrinfo(parts.hostname,
+                    parts.port or 80, 0, socket.SOCK_STREAM)
+            except socket.error, e:
+                self.reactor.call_soon(self._looked_up, generation, url,
+                    redirects, None, "failed to look up %s: %s" %
+                    (parts.hostname, e))
+            else:
+                self.reactor.call_soon(self._looked_up, generation, url,
+                    redirects, addresses[0], None)
+        
+        thread = threading.Thread(target=look_up,
+            name="StreamLookupThread-%s" % parts.hostname)
+        thread.setDaemon(True)
+        thread.start()
+    
+    def _looked_up(self, generation, url, redirects, address, error):
+        if self._closed or generation != self._generation:
+            return
+        if error:
+            self._failed(error)
+            return
+        
+        family, socktype, proto, canonname, sockaddr = address
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(False)
+        self._socket = sock
+        
+        code = sock.connect_ex(sockaddr)
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._failed("failed to connect to %s: %s" %
+                (url, os.strerror(code)))
+            return
+        
+        self.reactor.add_writer(sock, lambda: self._connected(sock, url,
+            redirects))
+    
+    def _connected(self, sock, url, redirects):
+        self.reactor.remove(sock)
+        code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code:
+            self._failed("failed to connect to %s: %s" %
+                (url, os.strerror(code)))
+            return
+        
+        parts = urlparse(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        host = parts.hostname
+        if parts.port:
+            host += ":%d" % parts.port
+        
+        request = ("GET %s HTTP/1.0\r\nHost: %s\r\nUser-Agent: Permanence\r\n"
+            "Accept: */*\r\nIcy-MetaData: 0\r\nConnection: close\r\n\r\n" %
+            (path, host))
+        try:
+            # the request is far smaller than any socket buffer
+            sock.send(request)
+        except socket.error, e:
+            self._failed("failed to send request to %s: %s" % (url, e))
+            return
+        
+        state = {"headers": ""}
+        self.reactor.add_reader(sock, lambda: self._readable(sock, url,
+            redirects, state))
+    
+    def _readable(self, sock, url, redirects, state):
+        try:
+            data = sock.recv(READ_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self._failed("lost connection to %s: %s" % (url, e))
+            return
+        
+        if not data:
+            self._failed("%s closed the connection" % url)
+            return
+        
+        if state["headers"] is not None:
+            state["headers"] += data
+            head, separator, body = state["headers"].partition("\r\n\r\n")
+            if not separator:
+                if len(state["headers"]) > MAX_HEADER_SIZE:
+                    self._failed("%s sent an invalid response" % url)
+                return
+            
+            state["headers"] = None
+            if not self._handle_response(url, redirects, head):
+                return
+            data = body
+            if not data:
+                return
+        
+        self._failures = 0
+        for receiver in list(self._receivers):
+            receiver(data, self.content_type)
+    
+    def _handle_response(self, url, redirects, head):
+        lines = head.split("\r\n")
+        match = re.match(r'^(?:HTTP/\d\.\d|ICY)\s+(\d{3})', lines[0])
+        if not match:
+            self._failed("%s sent an invalid response" % url)
+            return False
+        
+        status = int(match.group(1))
+        headers = {}
+        for line in lines[1:]:
+            name, colon, value = line.partition(":")
+            if colon:
+                headers[name.strip().lower()] = value.strip()
+        
+        if status in REDIRECT_STATUSES and headers.get("location"):
+            if redirects >= MAX_REDIRECTS:
+                self._failed("too many redirects from %s" %
+                    self.driver.stream)
+                return False
+            self._disconnect()
+            self._connect(urljoin(url, headers["location"]), redirects + 1)
+            return False
+        elif status != 200:
+            self._failed("%s responded with status %d" % (url, status))
+            return False
+        
+        self.content_type = (headers.get("content-type", "").split(";")[0].
+            strip().lower() or None)
+        return True
+    
+    def _disconnect(self):
+        if self._socket:
+            self.reactor.remove(self._socket)
+            self._socket.close()
+            self._socket = None
+    
+    def _failed(self, error, permanent=False):
+        self._disconnect()
+        self.last_error = error
+        if self._closed or permanent:
+            return
+        
+        delay = min(self.driver.max_reconnect_delay,
+            self.driver.reconnect_delay * (2 ** self._failures))
+        delay *= random.uniform(0.5, 1.0)
+        self._failures += 1
+        self._timer = self.reactor.call_later(delay, self._connect,
+            self.driver.stream, 0)
+
+class StreamRing(object):
+    """
+    Captures a stream into a ring buffer for as long as any driver that
+    records it with a ring is in use. Must only be used from the reactor
+    thread.
+    """
+    
+    # the ring of each stream being captured, by URL
+    _rings = {}
+    
+    def __init__(self, driver):
+        name = re.sub(r'\W+', '_', urlparse(driver.stream)[1]).lower()
+        # the ring is always there, so it does not count toward the quota
+        path = get_spool().allocate("ring-%s" % name, ".ring", counted=False)
+        self.stream = driver.stream
+        self.buffer = RingBuffer(path, driver.ring_size)
+        self.content_type = None
+        self.references = 0
+        self._capture = StreamCapture.attach(driver, self._received)
+    
+    @classmethod
+    def get(cls, stream):
+        return cls._rings.get(stream)
+    
+    @classmethod
+    def acquire(cls, driver):
+        ring = cls._rings.get(driver.stream)
+        if ring is None:
+            ring = cls._rings[driver.stream] = cls(driver)
+        ring.references += 1
+    
+    @classmethod
+    def release(cls, driver):
+        ring = cls._rings.get(driver.stream)
+        if ring is None:
+            return
+        
+        ring.references -= 1
+        if ring.references <= 0:
+            del cls._rings[driver.stream]
+            ring._capture.detach(ring._received)
+            ring.buffer.close()
+            get_spool().forget(ring.buffer.path)
+    
+    def _received(self, data, content_type):
+        self.content_type = content_type
+        self.buffer.write(data)
+
+class HTTPStreamDriver(object):
+    def __init__(self, stream, reconnect_delay=1.0, max_reconnect_delay=30.0,
+        lead_time=5.0, segment_length=None, ring_size=None):
+        self.stream = stream
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.lead_time = lead_time
+        self.segment_length = segment_length
+        self.ring_size = ring_size
+    
+    def spawn(self, show_name, identifier=None):
+        return HTTPStreamSession(self, show_name, identifier)
+    
+    def activate(self):
+        """Starts capturing the stream into its ring, if it has one."""
+        
+        if self.ring_size:
+            StreamReactor.get_instance().call_soon(StreamRing.acquire, self)
+    
+    def shutdown(self):
+        if self.ring_size:
+            StreamReactor.get_instance().call_soon(StreamRing.release, self)
+    
+    @classmethod
+    def from_config(cls, config):
+        try:
+            stream = config["stream"]
+        except KeyError:
+            raise ConfigurationError("must provide the stream to record")
+        if not stream.startswith("http://"):
+            raise ConfigurationError("can only record http:// streams, not "
+                "%r" % stream)
+        
+        try:
+            reconnect_delay = float(config.get("reconnect_delay", 1.0))
+            max_reconnect_delay = float(config.get("max_reconnect_delay",
+                30.0))
+        except ValueError, e:
+            raise ConfigurationError("invalid reconnection delay: %s" % e)
+        try:
+            lead_time = float(config.get("lead_time", 5.0))
+        except ValueError, e:
+            raise ConfigurationError("invalid lead time: %s" % e)
+        
+        segment_length = config.get("segment_length")
+        if segment_length is not None:
+            try:
+                segment_length = float(segment_length)
+            except ValueError, e:
+                raise ConfigurationError("invalid segment length: %s" % e)
+            if segment_length <= 0:
+                raise ConfigurationError("segment length must be positive")
+        
+        ring_size = config.get("ring_size")
+        if ring_size is not None:
+            try:
+                ring_size = parse_size(ring_size)
+            except ValueError, e:
+                raise ConfigurationError("invalid ring size: %s" % e)
+        
+        return cls(stream, reconnect_delay, max_reconnect_delay, lead_time,
+            segment_length, ring_size)
+    
+    def __repr__(self):
+        return "%s(%r, %r, %r, %r, %r, %r)" % (type(self).__name__,
+            self.stream, self.reconnect_delay, self.max_reconnect_delay,
+            self.lead_time, self.segment_length, self.ring_size)
+    
+    def __eq__(self, other):
+        return (isinstance(other, HTTPStreamDriver) and
+            self.stream == other.stream and
+            self.reconnect_delay == other.reconnect_delay and
+            self.max_reconnect_delay == other.max_reconnect_delay and
+            self.lead_time == other.lead_time and
+            self.segment_length == other.segment_length and
+            self.ring_size == other.ring_size)
+    
+    def __ne__(self, other):
+        return not (self == other)
+
+class HTTPStreamSession(EventSource):
+    def __init__(self, driver, show_name, identifier):
+        super(HTTPStreamSession, self).__init__()
+        self.driver = driver
+        self.show_name = show_name
+        self.identifier = identifier
+        self.reactor = StreamReactor.get_instance()
+        self.output_path = None
+        self.manifest_path = None
+        self.bytes_written = 0
+        self.segments = []
+        self._file = None
+        self._stem = None
+        self._segment_started = None
+        self._capture = None
+        self._timer = None
+        self._armed_at = None
+        self._admission = None
+        self._backfill_since = None
+        self._ended = True
+        self._started = False
+        self._cancelled = False
+        self._finished = threading.Event()
+    
+    def can_stop_automatically(self, duration):
+        return (duration < sys.maxint) if hasattr(sys, "maxint") else True
+    
+    def _get_output_path(self, content_type):
+        name = re.sub(r'\W+', '', re.sub(r'\s+', '_', self.show_name)).lower()
+        extension = CONTENT_TYPE_EXTENSIONS.get(content_type, "")
+        if not self.driver.segment_length:
+            return get_spool().allocate(name, extension)
+        
+        if self._stem is None:
+            self._stem = get_spool().allocate(name)
+        return "%s.part%03d%s" % (self._stem, len(self.segments) + 1,
+            extension)
+    
+    def prepare(self, start_time):
+        """
+        Connects to the stream ahead of the recording, and arranges for
+        recording to begin at the given time whether or not `start` has been
+        called by then.
+        """
+        
+        self._armed_at = start_time
+        self.reactor.call_soon(self._attach)
+    
+    def cancel(self):
+        """Abandons a prepared recording that has not been started."""
+        
+        self.reactor.call_soon(self._cancel)
+    
+    def backfill(self, since):
+        """
+        Has the recording, when started, begin with what the stream's ring
+        holds from the given time on. Does nothing if the driver has no ring,
+        or if the recording has already been receiving the stream.
+        """
+        
+        self._backfill_since = since
+    
+    def start(self, duration=None):
+        self.start_time = time.time()
+        self.duration = duration
+        self._started = True
+        self._ended = False
+        self.fire("start", session=self, duration=duration)
+        self.reactor.call_soon(self._begin, duration)
+    
+    def stop(self):
+        if self._ended:
+            raise RuntimeError("cannot stop stream recording; recording is "
+                "not running")
+        
+        self.reactor.call_soon(self._finish)
+        # wait for the recording to be closed, so that it is not still being
+        # written when the recorder goes to save it or shuts down
+        self._finished.wait(10.0)
+    
+    def _attach(self):
+        if self._capture is None and not self._cancelled:
+            self._capture = StreamCapture.attach(self.driver, self._received)
+    
+    def _cancel(self):
+        if self._started:
+            return
+        self._cancelled = True
+        if self._capture:
+            self._capture.detach(self._received)
+        if self._file:
+            self._file.close()
+            os.remove(self.output_path)
+    
+    def _begin(self, duration):
+        if self._ended:
+            return
+        if self._backfill_since is not None and not self.bytes_written:
+            self._backfill(self._backfill_since)
+        self._attach()
+        if duration:
+            self._timer = self.reactor.call_later(duration, self._finish)
+    
+    def _admitted(self):
+        # a prepared recording checks the spool once, when it is due to
+        # begin; if there is no room, it waits to be started (or cancelled)
+        # by the recorder rather than recording on its own
+        if self._admission is None:
+            self._admission = get_spool().admit()
+        return self._admission
+    
+    def _received(self, data, content_type):
+        if self._armed_at is not None and not self._started:
+            if time.time() < self._armed_at:
+                # connected early; the recording has not begun yet
+                return
+            if not self._admitted():
+                return
+        
+        if self._file is None and not self._open_file(content_type):
+            return
+        
+        try:
+            self._file.write(data)
+        except (IOError, OSError), e:
+            self._finish("failed to write recording: %s" % e)
+            return
+        self.bytes_written += len(data)
+        
+        length = self.driver.segment_length
+        if length and time.time() - self._segment_started >= length:
+            try:
+                self._end_segment()
+            except (IOError, OSError), e:
+                self._finish("failed to write recording: %s" % e)
+    
+    def _open_file(self, content_type, started=None):
+        try:
+            self.output_path = self._get_output_path(content_type)
+            self._file = open(self.output_path, "wb")
+        except (IOError, OSError), e:
+            self._finish("failed to create recording file: %s" % e)
+            return False
+        self._segment_started = started or time.time()
+        return True
+    
+    def _backfill(self, since):
+        # runs on the reactor thread before the session is attached to the
+        # capture, so that the ring and the capture pick up where the other
+        # leaves off
+        ring = StreamRing.get(self.driver.stream)
+        if ring is None or not ring.buffer.total:
+            return
+        
+        if not self._open_file(ring.content_type, since):
+            return
+        try:
+            started, length = ring.buffer.extract(since, self._file)
+        except (IOError, OSError), e:
+            self._finish("failed to copy the recording from the ring: %s" % e)
+            return
+        self.bytes_written += length
+        if started:
+            self._segment_started = started
+    
+    def _end_segment(self):
+        # closes the current segment; the next data received starts another
+        self._file.close()
+        self._file = None
+        
+        now = time.time()
+        self.segments.append({
+            "suffix": self.output_path[len(self._stem):],
+            "start_time": self._segment_started,
+            "duration": now - self._segment_started,
+            "size": os.path.getsize(self.output_path)
+        })
+        self.fire("segment", session=self, filename=self.output_path,
+            index=len(self.segments))
+    
+    def _write_manifest(self):
+        path = self._stem + ".manifest.json"
+        manifest = {
+            "show": self.show_name,
+            "stream": self.driver.stream,
+            "segment_length": self.driver.segment_length,
+            "segments": self.segments
+        }
+        with open(path, "wb") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        return path
+    
+    def _finish(self, error=None):
+        if self._ended:
+            return
+        self._ended = True
+        self.reactor.cancel(self._timer)
+        if self._capture:
+            self._capture.detach(self._received)
+        
+        try:
+            if self._file and self.driver.segment_length:
+                self._end_segment()
+            elif self._file:
+                self._file.close()
+            if self.segments and not error:
+                self.manifest_path = self._write_manifest()
+        except (IOError, OSError), e:
+            error = error or "failed to write recording: %s" % e
+        
+        if error is None and not self.bytes_written:
+            error = "nothing was received from the stream"
+            if self._capture and self._capture.last_error:
+                error += " (%s)" % self._capture.last_error
+        
+        try:
+            if error:
+                self.fire("error", session=self, error=error)
+            else:
+                self.fire("done", session=self,
+                    filename=self.manifest_path or self.output_path)
+        finally:
+            self._finished.set()
+
+Driver = HTTPStreamDriver
@@ -2,14 +2,30 @@
 
 """
 Implements a source driver that uses Jackoff.
+
+Normally, each recording runs its own jackoff process, which is a JACK client
+of its own. In shared mode, recordings are instead made by a single JACK
+client inside the recorder, which registers an input port for each port that
+any recording in progress needs (and drops it when none do) and writes each
+recording's channels to its own file. Shared mode needs the JACK-Client
+Python module, and records uncompressed WAV files (32-bit float samples)
+regardless of the configured format. Recordings too long for a WAV file's
+32-bit sizes are written as RF64 files instead.
 """
 
+from __future__ import with_statement
+
 from permanence.config import ConfigurationError
 from permanence.event import EventSource
 from permanence.monitor import monitor_process
-from permanence.temp import get_temp_directory
+from permanence.temp import get_spool
 from glob import glob
+from collections import deque
+from array import array
 import subprocess
+import threading
+import itertools
+import struct
 import time
 import sys
 import os
@@ -17,16 +33,28 @@ import os.path
 import signal
 import re
 
+try:
+    import jack
+except ImportError:
+    jack = None
+
 class JackoffDriver(object):
-    def __init__(self, executable, ports, format, bitrate, channels, name):
+    def __init__(self, executable, ports, format, bitrate, channels, name,
+        shared=False, lead_time=0):
         self.executable = executable
         self.ports = ports
         self.format = format
         self.bitrate = bitrate
         self.channels = channels
         self.client_name = name
+        self.shared = shared
+        
+        # only shared-mode sessions can be prepared ahead of time
+        self.lead_time = lead_time if shared else 0
     
     def spawn(self, show_name, identifier=None):
+        if self.shared:
+            return SharedJackSession(self, show_name, identifier)
         return JackoffSession(self, show_name, identifier)
     
     @classmethod
@@ -37,18 +65,35 @@ class JackoffDriver(object):
         bitrate = config.get("bitrate")
         channels = config.get("channels")
         ports = config.get("ports")
+        shared = bool(config.get("shared", False))
+        lead_time = config.get("lead_time", 1.0)
         
         if bitrate:
             bitrate = int(bitrate)
         if channels:
             channels = int(channels)
+        try:
+            lead_time = float(lead_time)
+        except ValueError, e:
+            raise ConfigurationError("invalid lead time: %s" % e)
+        if isinstance(ports, basestring):
+            ports = re.split(r'\s*,\s*', ports)
         
-        return cls(executable, ports, format, bitrate, channels, name)
+        if shared:
+            if jack is None:
+                raise ConfigurationError("shared JACK capture needs the "
+                    "JACK-Client Python module")
+            if not ports:
+                raise ConfigurationError("shared JACK capture needs the "
+                    "ports to record to be given")
+        
+        return cls(executable, ports, format, bitrate, channels, name, shared,
+            lead_time)
     
     def __repr__(self):
-        return "%s(%r, %r, %r, %r, %r)" % (type(self).__name__,
+        return "%s(%r, %r, %r, %r, %r, %r)" % (type(self).__name__,
             self.executable, self.format, self.bitrate, self.channels,
-            self.name)
+            self.client_name, self.shared)
     
     def __eq__(self, other):
         return (isinstance(other, JackoffDriver) and
@@ -57,7 +102,9 @@ class JackoffDriver(object):
             self.format == other.format and
             self.bitrate == other.bitrate and
             self.channels == other.channels and
-            self.client_name == other.client_name)
+            self.client_name == other.client_name and
+            self.shared == other.shared and
+            self.lead_time == other.lead_time)
     
     def __ne__(self, other):
         return not (self == other)
@@ -74,13 +121,12 @@ class JackoffSession(EventSource):
         return (duration < sys.maxint) if hasattr(sys, "maxint") else True
     
     def _get_output_path(self):
-        directory = get_temp_directory()
         name = re.sub(r'\W+', '', re.sub(r'\s+', '_', self.show_name)).lower()
         if not self.driver.format:
-            name += ".aiff"
+            extension = ".aiff"
         else:
-            name += "." + re.sub(r'\d+$', '', self.driver.format)
-        return os.path.join(directory, name)
+            extension = "." + re.sub(r'\d+$', '', self.driver.format)
+        return get_spool().allocate(name, extension)
     
     def start(self, duration=None):
         args = [self.driver.executable]
@@ -163,4 +209,324 @@ class JackoffSession(EventSource):
         except Exception:
             pass
 
+class SharedJackClient(object):
+    """
+    A JACK client, inside the recorder, that captures the ports needed by
+    every shared-mode recording in progress. The client is opened when the
+    first recording starts and closed when the last one ends.
+    
+    JACK calls `_process` from its realtime thread; it only copies the input
+    buffers onto the queues of the recordings that want them. The writer
+    thread empties those queues into the recordings' files.
+    
+    The realtime thread never takes the lock. It reads `_state`, a snapshot
+    of the recordings in progress and the ports they use, which is never
+    changed once published; changes are made by publishing a new snapshot.
+    A port that is no longer needed is unregistered by the writer thread
+    after a write interval has passed, by which time no call of `_process`
+    can still be using a snapshot that includes it.
+    """
+    
+    _instances = {}
+    _instances_lock = threading.Lock()
+    
+    WRITE_INTERVAL = 0.1
+    
+    def __init__(self, name):
+        self.name = name
+        self._client = None
+        self._port_users = {}
+        self._port_numbers = itertools.count()
+        self._retired_ports = []
+        self._state = ((), {})
+        self._lock = threading.RLock()
+        self._writer = None
+    
+    @classmethod
+    def get_instance(cls, name):
+        with cls._instances_lock:
+            if name not in cls._instances:
+                cls._instances[name] = cls(name)
+            return cls._instances[name]
+    
+    def add_session(self, session):
+        """
+        Starts capturing the ports of the given session's driver for it, and
+        returns the sample rate.
+        """
+        
+        with self._lock:
+            if self._client is None:
+                self._open()
+            
+            for port_name in session.driver.ports:
+                entry = self._port_users.get(port_name)
+                if entry is None:
+                    # ports are numbered by a counter, since ports that
+                    # have been dropped leave gaps
+                    port = self._client.inports.register("in_%d" %
+                        self._port_numbers.next())
+                    self._client.connect(port_name, port)
+                    entry = self._port_users[port_name] = [port, 0]
+                entry[1] += 1
+            
+            self._publish(self._state[0] + (session,))
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write,
+                    name="JackWriterThread-%s" % self.name)
+                self._writer.start()
+            return self._client.samplerate
+    
+    def remove_session(self, session):
+        with self._lock:
+            sessions = self._state[0]
+            if session not in sessions:
+                return
+            
+            retired = []
+            for port_name in session.driver.ports:
+                entry = self._port_users[port_name]
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._port_users[port_name]
+                    retired.append(entry[0])
+            
+            sessions = tuple(s for s in sessions if s is not session)
+            self._publish(sessions)
+            if not sessions:
+                self._close()
+            else:
+                self._retired_ports.extend((self._client, port)
+                    for port in retired)
+    
+    def _publish(self, sessions):
+        # must be called with the lock held
+        ports = dict((name, entry[0]) for name, entry
+            in self._port_users.iteritems())
+        self._state = (sessions, ports)
+    
+    def _open(self):
+        self._client = jack.Client(self.name, no_start_server=True)
+        self._client.set_process_callback(self._process)
+        self._client.activate()
+    
+    def _close(self):
+        # must be called with the lock held, once the published snapshot is
+        # empty; closing the client drops its ports
+        client, self._client = self._client, None
+        self._port_users = {}
+        self._retired_ports = []
+        try:
+            client.deactivate()
+            client.close()
+        except jack.JackError:
+            pass
+    
+    def _process(self, frames):
+        sessions, ports = self._state
+        buffers = {}
+        now = time.time()
+        for session in sessions:
+            chunk = []
+            for port_name in session.driver.ports:
+                if port_name not in buffers:
+                    port = ports.get(port_name)
+                    if port is None:
+                        break
+                    buffers[port_name] = bytes(port.get_buffer())
+                chunk.append(buffers[port_name])
+            else:
+                session.queue.append((now, chunk))
+    
+    def _write(self):
+        while True:
+            with self._lock:
+                retired, self._retired_ports = self._retired_ports, []
+            time.sleep(self.WRITE_INTERVAL)
+            with self._lock:
+                for client, port in retired:
+                    if client is self._client:
+                        try:
+                            port.unregister()
+                        except jack.JackError:
+                            pass
+                sessions = self._state[0]
+                if not sessions:
+                    self._writer = None
+                    return
+            for session in sessions:
+                session.flush()
+
+class SharedJackSession(EventSource):
+    """Records from the driver's ports through the shared JACK client."""
+    
+    # RIFF header, a JUNK chunk that becomes the "ds64" chunk of an RF64
+    # file, then the fmt, fact and data chunk headers
+    HEADER_FORMAT = "<4sI4s4sIQQQI4sIHHIIHHH4sII4sI"
+    MAX_SIZE = 0xFFFFFFFF
+    
+    def __init__(self, driver, show_name, identifier):
+        super(SharedJackSession, self).__init__()
+        self.driver = driver
+        self.show_name = show_name
+        self.identifier = identifier
+        self.queue = deque()
+        self.frames_written = 0
+        self._file = None
+        self._timer = None
+        self._write_lock = threading.Lock()
+        self._armed_at = None
+        self._admission = None
+        self._ended = True
+        self._started = False
+        self._client = SharedJackClient.get_instance(driver.client_name or
+            "permanence")
+    
+    def can_stop_automatically(self, duration):
+        return (duration < sys.maxint) if hasattr(sys, "maxint") else True
+    
+    def _get_output_path(self):
+        name = re.sub(r'\W+', '', re.sub(r'\s+', '_', self.show_name)).lower()
+        return get_spool().allocate(name, ".wav")
+    
+    def prepare(self, start_time):
+        """
+        Starts capturing the driver's ports ahead of the recording; audio
+        captured before the given start time is discarded.
+        """
+        
+        self._armed_at = start_time
+        self._open()
+    
+    def cancel(self):
+        """Abandons a prepared recording that has not been started."""
+        
+        if self._started or self._file is None:
+            return
+        self._client.remove_session(self)
+        with self._write_lock:
+            self._file.close()
+        os.remove(self.output_path)
+    
+    def _open(self):
+        self.channels = len(self.driver.ports)
+        self.output_path = self._get_output_path()
+        self._file = open(self.output_path, "wb")
+        try:
+            self._file.write(self._get_header(0, 0))
+            self.sample_rate = self._client.add_session(self)
+        except:
+            self._file.close()
+            os.remove(self.output_path)
+            self._file = None
+            raise
+    
+    def start(self, duration=None):
+        self.duration = duration
+        self.start_time = time.time()
+        
+        if self._file is None:
+            try:
+                self._open()
+            except Exception, e:
+                self.fire("error", session=self,
+                    error="failed to start recording: %s" % e)
+                return
+        
+        self._started = True
+        self._ended = False
+        if duration:
+            self._timer = threading.Timer(duration, self._end)
+            self._timer.setDaemon(True)
+            self._timer.start()
+        self.fire("start", session=self, duration=duration)
+    
+    def stop(self):
+        if self._ended:
+            raise RuntimeError("cannot stop JACK recording; recording is not "
+                "running")
+        self._end()
+    
+    def flush(self):
+        """Writes the audio captured so far to the recording's file."""
+        
+        with self._write_lock:
+            if self._file is None or self._file.closed:
+                return
+            while self.queue:
+                captured_at, chunk = self.queue.popleft()
+                if self._armed_at and captured_at < self._armed_at:
+                    # captured before the recording was to begin
+                    continue
+                if not self._started and not self._admitted():
+                    continue
+                self._file.write(self._interleave(chunk))
+                self.frames_written += len(chunk[0]) // 4
+    
+    def _admitted(self):
+        # a prepared recording checks the spool once, when it is due to
+        # begin; if there is no room, it waits to be started (or cancelled)
+        # by the recorder rather than recording on its own
+        if self._admission is None:
+            self._admission = get_spool().admit()
+        return self._admission
+    
+    def _interleave(self, chunk):
+        if len(chunk) == 1:
+            return chunk[0]
+        
+        channels = len(chunk)
+        samples = array("f")
+        samples.fromstring("\0" * (len(chunk[0]) * channels))
+        for channel, data in enumerate(chunk):
+            samples[channel::channels] = array("f", data)
+        return samples.tostring()
+    
+    def _get_header(self, frames, sample_rate):
+        block_align = 4 * self.channels
+        data_size = frames * block_align
+        riff_size = struct.calcsize(self.HEADER_FORMAT) - 8 + data_size
+        
+        if riff_size > self.MAX_SIZE or frames > self.MAX_SIZE:
+            # the real sizes go in the ds64 chunk; the 32-bit fields are
+            # set to their maximum, as RF64 requires
+            riff_id, space_id = "RF64", "ds64"
+            riff_field = data_field = frames_field = self.MAX_SIZE
+        else:
+            riff_id, space_id = "RIFF", "JUNK"
+            riff_field, data_field, frames_field = riff_size, data_size, frames
+        
+        return struct.pack(self.HEADER_FORMAT, riff_id, riff_field, "WAVE",
+            space_id, 28, riff_size, data_size, frames, 0, "fmt ", 18, 3,
+            self.channels, sample_rate, sample_rate * block_align,
+            block_align, 32, 0, "fact", 4, frames_field, "data", data_field)
+    
+    def _end(self):
+        with self._write_lock:
+            if self._ended:
+                return
+            self._ended = True
+        
+        if self._timer:
+            self._timer.cancel()
+        self._client.remove_session(self)
+        
+        try:
+            self.flush()
+            with self._write_lock:
+                self._file.seek(0)
+                self._file.write(self._get_header(self.frames_written,
+                    self.sample_rate))
+                self._file.close()
+        except (IOError, OSError, struct.error), e:
+            self.fire("error", session=self,
+                error="failed to write recording: %s" % e)
+            return
+        
+        if not self.frames_written:
+            self.fire("error", session=self,
+                error="nothing was captured from JACK")
+        else:
+            self.fire("done", session=self, filename=self.output_path)
+
 Driver = JackoffDriver
@@ -7,7 +7,7 @@ Implements a source driver that uses StreamRipper.
 from permanence.config import ConfigurationError
 from permanence.event import EventSource
 from permanence.monitor import monitor_process
-from permanence.temp import get_temp_directory
+from permanence.temp import get_spool
 from glob import glob
 import subprocess
 import time
@@ -59,9 +59,8 @@ class StreamRipperSession(EventSource):
         return (duration < sys.maxint) if hasattr(sys, "maxint") else True
         
     def _get_output_path(self):
-        directory = get_temp_directory()
         name = re.sub(r'\W+', '', re.sub(r'\s+', '_', self.show_name)).lower()
-        return os.path.join(directory, name)
+        return get_spool().allocate(name)
     
     def start(self, duration=None):
         args = [self.driver.executable, self.driver.stream, "-A"]
@@ -128,12 +127,22 @@ class StreamRipperSession(EventSource):
         except Exception:
             pass
     
+    def find_recorded_file(self):
+        """
+        Returns the path of the file that streamripper is recording to, which
+        it names by adding an extension to the output path, or None if it has
+        not created it yet.
+        """
+        
+        matches = glob("%s.*" % self.output_path)
+        return matches[0] if matches else None
+    
     def _get_recorded_file_name(self):
-        pattern = "%s.*" % self.output_path
-        matches = glob(pattern)
-        if len(matches) == 0:
+        filename = self.find_recorded_file()
+        if filename is None:
             self.fire("error", session=self, error="could not find "
-                "streamripper output file (looked for %s)" % pattern)
-        return matches[0]
+                "streamripper output file (looked for %s.*)" %
+                self.output_path)
+        return filename
 
 Driver = StreamRipperDriver
@@ -6,24 +6,36 @@ Implements a storage driver that saves recordings as regular files.
 
 from permanence.config import ConfigurationError
 from permanence.event import EventSource
-from permanence.storage.util import compile_path_pattern
+from permanence.storage.util import (compile_path_pattern, copy_file,
+    get_file_extension)
+from permanence.temp import get_spool
 import os.path
-import shutil
 
 class FilesystemDriver(EventSource):
-    def __init__(self, path_creator):
+    """
+    Saves recordings by copying them into place.
+    
+    A recording in the spool that no other storage location still needs is
+    hard-linked into place instead, since the spool is about to delete it;
+    if `hardlink` is true, recordings are hard-linked whenever possible.
+    """
+    
+    def __init__(self, path_creator, hardlink=False):
         super(FilesystemDriver, self).__init__()
         self.path_creator = path_creator
+        self.hardlink = hardlink
     
     def save(self, source, show, file_path):
-        extension = os.path.splitext(file_path)[1]
+        extension = get_file_extension(file_path)
         dest_path = self.path_creator(source, show) + extension
         directory, filename = os.path.split(dest_path)
         if not os.path.isdir(directory):
             os.makedirs(directory)
         
-        shutil.copy2(file_path, dest_path)
-        self.fire("save", source=source, show=show, location=dest_path)
+        link = self.hardlink or get_spool().get_consumers(file_path) == 1
+        copy_file(file_path, dest_path, link)
+        self.fire("save", source=source, show=show, location=dest_path,
+            file_path=file_path)
     
     @classmethod
     def from_config(cls, config):
@@ -36,6 +48,6 @@ class FilesystemDriver(EventSource):
         except ValueError, e:
             raise ConfigurationError("invalid filesystem storage location: "
                 "%s" % e)
-        return cls(creator)
+        return cls(creator, bool(config.get("hardlink", False)))
     
 Driver = FilesystemDriver
@@ -0,0 +1,143 @@
+# encoding: utf-8
+
+"""
+Hands finished recordings to storage drivers away from the threads that
+notice recordings finishing.
+"""
+
+from __future__ import with_statement
+
+from permanence.event import EventSource
+from permanence.storage.util import ActionQueue
+import threading
+
+class StorageJob(object):
+    """
+    A recording being saved to each of its source's storage locations.
+    
+    `locations` maps each driver that has saved the recording to the location
+    it reported, and `errors` maps each driver that failed to the error.
+    """
+    
+    def __init__(self, source, show, file_path, drivers):
+        self.source = source
+        self.show = show
+        self.file_path = file_path
+        self.pending = list(drivers)
+        self.locations = {}
+        self.errors = {}
+    
+    def is_complete(self):
+        return not self.pending
+    
+    def succeeded(self):
+        return self.is_complete() and not self.errors
+
+class StoragePipeline(EventSource):
+    """
+    Saves recordings to storage from a pool of worker threads, so that the
+    process monitor and the recorder loop never wait on disk or network I/O.
+    
+    Each of a recording's storage drivers is given the recording as a
+    separate task, so that the drivers work on it concurrently. The pipeline
+    tracks the outcome for each driver and fires:
+    
+    - "save" (source, show, location) when a driver saves a recording;
+    - "error" (source, show, error) when a driver fails to;
+    - "complete" (job) once every driver has done one or the other.
+    
+    Drivers must be registered with `observe_driver` before recordings are
+    given to them.
+    """
+    
+    def __init__(self, worker_count=2):
+        super(StoragePipeline, self).__init__()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._queue = ActionQueue(self._save, worker_count, max_attempts=1,
+            failure_handler=self._save_failed)
+    
+    def observe_driver(self, driver):
+        def saved(source, show, location, file_path=None):
+            job = self._find_job(driver, source, show, file_path)
+            self.fire("save", source=source, show=show, location=location)
+            if job:
+                self._driver_finished(job, driver, location=location)
+        
+        def failed(source, show, error, file_path=None):
+            job = self._find_job(driver, source, show, file_path)
+            self.fire("error", source=source, show=show, error=error)
+            if job:
+                self._driver_finished(job, driver, error=error)
+        
+        driver.observe("save", saved)
+        driver.observe("error", failed)
+    
+    def store(self, source, show, file_path, drivers=None):
+        """
+        Saves a recording to each of its source's storage locations, or only
+        to the given drivers.
+        """
+        
+        if drivers is None:
+            drivers = source.storage
+        job = StorageJob(source, show, file_path, drivers)
+        with self._lock:
+            for driver in job.pending:
+                self._jobs.setdefault(id(driver), []).append(job)
+        
+        if job.is_complete():
+            self.fire("complete", job=job)
+        for driver in list(job.pending):
+            self._queue.add((job, driver))
+        return job
+    
+    def shutdown(self):
+        """
+        Stops the pipeline once the recordings already given to it have been
+        handed to their drivers.
+        """
+        
+        self._queue.shutdown(drain=True)
+    
+    def _save(self, task):
+        job, driver = task
+        driver.save(job.source, job.show, job.file_path)
+    
+    def _save_failed(self, task, error_type, error, traceback):
+        job, driver = task
+        self.fire("error", source=job.source, show=job.show, error=error)
+        self._driver_finished(job, driver, error=error)
+    
+    def _find_job(self, driver, source, show, file_path):
+        # Drivers that report the file they saved are matched exactly; for
+        # others, the oldest recording of the show given to the driver is
+        # assumed to be the one it is reporting on.
+        with self._lock:
+            for job in self._jobs.get(id(driver), ()):
+                if file_path is not None:
+                    if job.file_path == file_path:
+                        return job
+                elif job.source is source and job.show is show:
+                    return job
+        return None
+    
+    def _driver_finished(self, job, driver, location=None, error=None):
+        with self._lock:
+            if driver not in job.pending:
+                return
+            
+            job.pending.remove(driver)
+            if error is not None:
+                job.errors[driver] = error
+            else:
+                job.locations[driver] = location
+            
+            jobs = self._jobs[id(driver)]
+            jobs.remove(job)
+            if not jobs:
+                del self._jobs[id(driver)]
+            complete = job.is_complete()
+        
+        if complete:
+            self.fire("complete", job=job)
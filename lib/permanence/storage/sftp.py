@@ -8,14 +8,200 @@ from __future__ import with_statement
 
 from permanence.config import ConfigurationError
 from permanence.event import EventSource
-from permanence.storage.util import ActionQueue, compile_path_pattern
+from permanence.storage.util import (ActionQueue, compile_path_pattern,
+    get_file_extension)
 
 import paramiko
+import contextlib
+import hashlib
+import threading
+import time
 import os.path
 import posixpath
 
+class SFTPConnection(object):
+    """An SSH connection and the SFTP session open on it."""
+    
+    def __init__(self, client, sftp):
+        self.client = client
+        self.sftp = sftp
+        self.last_used = time.time()
+    
+    def is_alive(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+    
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+class SFTPConnectionPool(object):
+    """
+    Keeps connections to an SFTP server open for reuse.
+    
+    Connections are made by calling `connect`, which must return an
+    `SFTPConnection` (or any object with the same interface). A connection
+    that has been idle for more than `check_after` seconds is checked with a
+    round trip to the server before it is reused, and connections idle for
+    more than `max_idle` seconds are closed.
+    
+    The pool also remembers which remote directories are known to exist, so
+    that uploads into a directory that has been used before do not need to
+    check for it again.
+    """
+    
+    def __init__(self, connect, max_idle=300.0, check_after=30.0):
+        self._connect = connect
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.directories = set()
+        self.users = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._timer = None
+    
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool. If the block raises an exception,
+        the connection is assumed to be unusable and is closed instead of
+        being returned to the pool.
+        """
+        
+        connection = self._acquire()
+        try:
+            yield connection
+        except:
+            connection.close()
+            raise
+        else:
+            self._release(connection)
+    
+    def remember_directory(self, path):
+        """Records that the given directory and its parents exist."""
+        
+        with self._lock:
+            for directory in self._get_lineage(path):
+                self.directories.add(directory)
+    
+    def forget_directory(self, path):
+        """Forgets that the given directory and its parents exist."""
+        
+        with self._lock:
+            for directory in self._get_lineage(path):
+                self.directories.discard(directory)
+    
+    def _get_lineage(self, path):
+        while path:
+            yield path
+            parent = posixpath.dirname(path)
+            if parent == path:
+                break
+            path = parent
+    
+    def evict_idle(self):
+        """Closes any connections that have been idle for too long."""
+        
+        cutoff = time.time() - self.max_idle
+        with self._lock:
+            expired = [c for c in self._idle if c.last_used < cutoff]
+            self._idle = [c for c in self._idle if c.last_used >= cutoff]
+            self._timer = None
+            self._schedule_eviction()
+        
+        for connection in expired:
+            connection.close()
+    
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        
+        for connection in idle:
+            connection.close()
+    
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            
+            if self._is_usable(connection):
+                return connection
+            connection.close()
+        
+        return self._connect()
+    
+    def _is_usable(self, connection):
+        idle_time = time.time() - connection.last_used
+        if idle_time > self.max_idle or not connection.is_alive():
+            return False
+        
+        if idle_time > self.check_after:
+            try:
+                connection.sftp.normalize(".")
+            except Exception:
+                return False
+        return True
+    
+    def _release(self, connection):
+        connection.last_used = time.time()
+        with self._lock:
+            self._idle.append(connection)
+            self._schedule_eviction()
+    
+    def _schedule_eviction(self):
+        # must be called with the lock held
+        if self._timer or not self._idle:
+            return
+        
+        oldest = min(c.last_used for c in self._idle)
+        delay = max(0, oldest + self.max_idle - time.time()) + 1
+        self._timer = threading.Timer(delay, self.evict_idle)
+        self._timer.setDaemon(True)
+        self._timer.start()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_connection_pool(host, port, username, connect, credentials=()):
+    """
+    Returns the connection pool for the given server and user, creating it
+    (with the given `connect` function) if necessary. Each call should be
+    balanced by a call to `release_connection_pool`.
+    
+    Drivers only share a pool if they also have the same `credentials`, so
+    that a driver whose password or key has changed does not go on using
+    connections made with the old ones.
+    """
+    
+    key = (host, port, username, tuple(credentials))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SFTPConnectionPool(connect)
+        pool.users += 1
+        return pool
+
+def release_connection_pool(pool):
+    with _pools_lock:
+        pool.users -= 1
+        if pool.users > 0:
+            return
+        
+        for key, value in _pools.items():
+            if value is pool:
+                del _pools[key]
+    pool.close()
+
 class SFTPDriver(EventSource):
-    def __init__(self, host, path_creator, username, password=None, key=None):
+    def __init__(self, host, path_creator, username, password=None, key=None,
+        workers=2, max_attempts=5):
         super(SFTPDriver, self).__init__()
         
         self.host = host[0]
@@ -24,8 +210,14 @@ class SFTPDriver(EventSource):
         self.username = username
         self.password = password
         self.key = key
+        self.keepalive = 30
+        self.block_size = 32768
         
-        self._queue = ActionQueue(self._upload)
+        self._pool = get_connection_pool(self.host, self.port, username,
+            self._connect, (password, key))
+        self._queue = ActionQueue(self._upload, workers,
+            max_attempts=max_attempts, failure_handler=self._upload_failed,
+            stop_handler=self._stopped)
     
     @classmethod
     def from_config(cls, config):
@@ -40,22 +232,31 @@ class SFTPDriver(EventSource):
             raise ConfigurationError("invalid remote SFTP storage path: "
                 "%s" % e)
         
+        try:
+            workers = int(config.get('workers', 2))
+            max_attempts = int(config.get('max_attempts', 5))
+        except ValueError, e:
+            raise ConfigurationError("invalid SFTP storage driver "
+                "configuration: %s" % e)
+        
         host = (config['host'], int(config.get('port', 22)))
         return cls(host, creator, config['username'], config.get('password'),
-            config.get('key_file'))
+            config.get('key_file'), workers, max_attempts)
     
     def save(self, source, show, file_path):
-        extension = os.path.splitext(file_path)[1]
+        extension = get_file_extension(file_path)
         dest_filename = self.path_creator(source, show) + extension
         
         self._queue.add((source, show, file_path, dest_filename))
     
     def shutdown(self):
-        self._queue.shutdown()
+        # the pool is released once the queued uploads have been made
+        self._queue.shutdown(drain=True)
     
-    def _upload(self, item):
-        source, show, source_path, dest_path = item
-        
+    def _stopped(self):
+        release_connection_pool(self._pool)
+    
+    def _connect(self):
         client = paramiko.SSHClient()
         client.load_system_host_keys()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -63,39 +264,171 @@ class SFTPDriver(EventSource):
         try:
             client.connect(self.host, self.port, self.username, self.password,
                 key_filename=self.key, timeout=15.0, look_for_keys=True)
-        except Exception, e:
-            self.fire("error", source=source, show=show, error=e)
-            return
+            client.get_transport().set_keepalive(self.keepalive)
+            return SFTPConnection(client, client.open_sftp())
+        except:
+            client.close()
+            raise
+    
+    def _upload(self, item):
+        # Any exception raised here causes the upload to be retried by the
+        # action queue; see _upload_failed.
+        source, show, source_path, dest_path = item
         
-        sftp = client.open_sftp()
         try:
-            self._ensure_path(sftp, dest_path)
-            sftp.put(source_path, dest_path)
-        except Exception, e:
-            self.fire("error", source=source, show=show, error=e)
-            return
+            with self._pool.connection() as connection:
+                self._ensure_path(connection.sftp, dest_path)
+                self._transfer(connection.sftp, source_path, dest_path)
+        except IOError:
+            # the remote directory may have been removed behind our back
+            self._pool.forget_directory(posixpath.dirname(dest_path))
+            raise
         
-        client.close()
         self.fire("save", source=source, show=show, location="%s:%s" %
-            (self.host, dest_path))
+            (self.host, dest_path), file_path=source_path)
     
-    def _ensure_path(self, sftp, dest_path):
-        directory, filename = posixpath.split(dest_path)
+    def _transfer(self, sftp, source_path, dest_path):
+        """
+        Uploads a file to a temporary ".part" file next to its destination,
+        then moves it into place. If a previous attempt left a partial upload
+        behind, and the part already uploaded matches the local file, the
+        upload resumes where it left off. Writes are pipelined so that the
+        link stays busy instead of waiting for each block to be acknowledged.
+        """
+        
+        partial_path = dest_path + ".part"
+        size = os.path.getsize(source_path)
+        offset = self._get_resume_offset(sftp, source_path, partial_path, size)
+        
+        with open(source_path, "rb") as local_file:
+            remote_file = sftp.open(partial_path, "r+b" if offset else "wb")
+            try:
+                remote_file.set_pipelined(True)
+                remote_file.seek(offset)
+                local_file.seek(offset)
+                while True:
+                    block = local_file.read(self.block_size)
+                    if not block:
+                        break
+                    remote_file.write(block)
+            finally:
+                # closing the file waits for the pipelined writes to finish
+                remote_file.close()
+        
+        uploaded = sftp.stat(partial_path).st_size
+        if uploaded != size:
+            raise IOError("size mismatch after upload of %s: expected %d "
+                "bytes, but the server has %d" % (dest_path, size, uploaded))
+        
+        try:
+            sftp.posix_rename(partial_path, dest_path)
+        except (AttributeError, IOError):
+            # the server (or paramiko) does not support POSIX renames, and a
+            # plain SFTP rename will not overwrite an existing file
+            try:
+                sftp.remove(dest_path)
+            except IOError:
+                pass
+            sftp.rename(partial_path, dest_path)
+    
+    def _get_resume_offset(self, sftp, source_path, partial_path, size):
+        """
+        Returns the offset from which an upload to the given partial file can
+        be resumed: the size of the partial file, if its contents match the
+        start of the local file, or 0.
+        """
+        
+        try:
+            uploaded = sftp.stat(partial_path).st_size
+        except IOError:
+            return 0
+        
+        if not uploaded or uploaded > size:
+            return 0
+        
+        with open(source_path, "rb") as local_file:
+            remote_file = sftp.open(partial_path, "rb")
+            try:
+                matches = self._prefix_matches(local_file, remote_file,
+                    uploaded)
+            finally:
+                remote_file.close()
+        
+        return uploaded if matches else 0
+    
+    def _prefix_matches(self, local_file, remote_file, length):
+        """
+        Checks that the first `length` bytes of the local and remote files
+        are the same.
+        
+        The server is asked to hash the remote prefix with the "check-file"
+        extension. Many servers (including OpenSSH) lack that extension, in
+        which case a handful of sampled blocks, always including the final
+        one, are downloaded and compared instead; a failed transfer leaves
+        damage at the end of the partial file, which this catches without
+        reading the whole prefix back.
+        """
+        
         try:
-            sftp.chdir(directory)
-            return True
+            remote_hash = remote_file.check("sha1", 0, length)
         except IOError:
+            remote_hash = None
+        
+        if remote_hash is not None:
+            local_hash = hashlib.sha1()
+            remaining = length
+            while remaining > 0:
+                block = local_file.read(min(self.block_size, remaining))
+                if not block:
+                    return False
+                local_hash.update(block)
+                remaining -= len(block)
+            return local_hash.digest() == remote_hash
+        
+        block_size = min(self.block_size, length)
+        samples = 8
+        offsets = set(((length - block_size) * i) // samples
+            for i in xrange(samples + 1))
+        for offset in sorted(offsets):
+            local_file.seek(offset)
+            remote_file.seek(offset)
+            if local_file.read(block_size) != remote_file.read(block_size):
+                return False
+        return True
+    
+    def _upload_failed(self, item, error_type, error, traceback):
+        source, show, source_path, dest_path = item
+        self.fire("error", source=source, show=show, error=error,
+            file_path=source_path)
+    
+    def _ensure_path(self, sftp, dest_path):
+        """
+        Creates the remote directory that will contain the given path if it
+        does not already exist.
+        """
+        
+        known = self._pool.directories
+        directory = posixpath.dirname(dest_path)
+        missing = []
+        
+        while directory and directory not in known:
             try:
-                parent, child = posixpath.split(directory)
-                sftp.chdir(parent)
+                sftp.stat(directory)
+                break
             except IOError:
-                if self._ensure_path(sftp, directory):
-                    sftp.mkdir(directory)
-                    return True
-            else:
-                sftp.mkdir(child)
-                return True
-            
-            raise
+                missing.append(directory)
+                parent = posixpath.dirname(directory)
+                if parent == directory:
+                    break
+                directory = parent
+        
+        for directory in reversed(missing):
+            try:
+                sftp.mkdir(directory)
+            except IOError:
+                # another upload may have created it in the meantime
+                sftp.stat(directory)
+        
+        self._pool.remember_directory(posixpath.dirname(dest_path))
 
 Driver = SFTPDriver
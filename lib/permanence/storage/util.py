@@ -4,18 +4,56 @@
 Utility code for storage drivers.
 """
 
+from __future__ import with_statement
+
 import re
+import os
 import sys
 import time
+import heapq
+import errno
+import random
+import shutil
+import itertools
 import threading
 
 class ActionQueue(object):
-    def __init__(self, handler, worker_count=2, error_handler=None):
+    """
+    Calls a handler on queued items from a pool of worker threads.
+    
+    Items that are ready are kept in a heap ordered by priority (lower values
+    first) and then by the order they were added in; items waiting to be
+    retried are kept in a second heap, ordered by the time at which they
+    become ready, and move to the first once that time comes. Idle workers
+    sleep until an item is ready and call the handler without holding the
+    queue's lock, so up to `worker_count` items are handled at once.
+    
+    If the handler raises an exception, `error_handler` is called with the
+    exception info and the item is tried again after a randomized,
+    exponentially-growing delay. Once an item has been tried `max_attempts`
+    times, it is dropped and `failure_handler` is called with the item and
+    the exception info.
+    
+    Once the queue has been shut down and its last worker has stopped,
+    `stop_handler` is called (from that worker's thread).
+    """
+    
+    def __init__(self, handler, worker_count=2, error_handler=None,
+        max_attempts=None, failure_handler=None, max_delay=600.0,
+        stop_handler=None):
         self._handler = handler
         self._queue = []
-        self._queue_control = threading.Lock()
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._ready = threading.Condition(threading.Lock())
         self._running = True
+        self._draining = False
         self._error_handler = error_handler
+        self._failure_handler = failure_handler
+        self._stop_handler = stop_handler
+        self._live_workers = worker_count
+        self.max_attempts = max_attempts
+        self.max_delay = max_delay
         self._create_workers(worker_count)
     
     def _create_workers(self, worker_count):
@@ -27,37 +65,309 @@ class ActionQueue(object):
         self._workers = [create_thread() for i in xrange(worker_count)]
     
     def _run(self):
-        def execute_task(item, attempt):
+        while True:
+            task = self._next_task()
+            if task is None:
+                self._worker_stopped()
+                return
+            
+            priority, sequence, item, attempt = task
             try:
                 self._handler(item)
             except Exception:
+                error = sys.exc_info()
                 if self._error_handler:
-                    self._error_handler(*sys.exc_info())
-                self._schedule(item, attempt + 1)
-        
-        while self._running:
-            with self._queue_control:
+                    self._error_handler(*error)
+                
+                attempt += 1
+                if self.max_attempts and attempt >= self.max_attempts:
+                    if self._failure_handler:
+                        self._failure_handler(item, *error)
+                else:
+                    self._schedule(item, attempt, priority)
+                del error
+    
+    def _next_task(self):
+        with self._ready:
+            while self._running or (self._draining and
+                (self._queue or self._delayed)):
                 now = time.time()
+                while self._delayed and self._delayed[0][0] <= now:
+                    heapq.heappush(self._queue,
+                        heapq.heappop(self._delayed)[1:])
                 
-                for i in xrange(len(self._queue)):
-                    if now >= self._queue[i][2]:
-                        task = self._queue.pop(i)
-                        execute_task(task[0], task[1])
+                if self._queue:
+                    return heapq.heappop(self._queue)
+                elif self._delayed:
+                    self._ready.wait(self._delayed[0][0] - now)
+                else:
+                    self._ready.wait()
+        return None
+    
+    def _worker_stopped(self):
+        with self._ready:
+            self._live_workers -= 1
+            last = not self._live_workers
+        if last and self._stop_handler:
+            self._stop_handler()
+    
+    def add(self, item, priority=0):
+        self._schedule(item, 0, priority)
+    
+    def _get_delay(self, attempt):
+        if attempt <= 0:
+            return 0
+        delay = min(self.max_delay, 1.6 ** attempt)
+        return random.uniform(delay / 2, delay)
+    
+    def _schedule(self, item, attempt, priority):
+        delay = self._get_delay(attempt)
+        
+        with self._ready:
+            task = (priority, self._sequence.next(), item, attempt)
+            if delay > 0:
+                heapq.heappush(self._delayed, (time.time() + delay,) + task)
+            else:
+                heapq.heappush(self._queue, task)
+            self._ready.notify()
+    
+    def shutdown(self, drain=False):
+        """
+        Stops the workers. If `drain` is true, they first finish everything
+        already in the queue (including any retries); otherwise, they stop
+        once they finish the items they are currently handling.
+        """
+        
+        with self._ready:
+            self._running = False
+            self._draining = drain
+            self._ready.notifyAll()
+
+# errors that mean a copying method cannot be used for a particular file, in
+# which case the next method is tried
+_UNSUPPORTED_ERRORS = frozenset(getattr(errno, name) for name in
+    ("EXDEV", "ENOSYS", "EINVAL", "EOPNOTSUPP", "ENOTSUP", "ENOTTY", "EBADF")
+    if hasattr(errno, name))
+
+_FICLONE = 0x40049409
+_CHUNK_SIZE = 0x40000000
+
+def _get_libc_function(name, restype, argtypes):
+    try:
+        import ctypes
+        function = getattr(ctypes.CDLL(None, use_errno=True), name)
+    except (ImportError, OSError, AttributeError):
+        return None
+    
+    function.restype = getattr(ctypes, restype)
+    function.argtypes = [getattr(ctypes, t) for t in argtypes]
+    
+    def call(*args):
+        result = function(*args)
+        if result < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return result
+    return call
+
+def _copy_by_reflink(source, dest):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    
+    fcntl.ioctl(dest.fileno(), _FICLONE, source.fileno())
+    return True
+
+def _copy_by_syscall(copy_chunk):
+    def copy(source, dest):
+        if copy_chunk is None:
+            return False
+        
+        while copy_chunk(source.fileno(), dest.fileno()) > 0:
+            pass
+        return True
+    return copy
+
+def _get_copy_file_range():
+    if hasattr(os, "copy_file_range"):
+        return lambda src, dst: os.copy_file_range(src, dst, _CHUNK_SIZE)
+    
+    function = _get_libc_function("copy_file_range", "c_ssize_t",
+        ("c_int", "c_void_p", "c_int", "c_void_p", "c_size_t", "c_uint"))
+    if function:
+        return lambda src, dst: function(src, None, dst, None, _CHUNK_SIZE, 0)
+    return None
+
+def _get_sendfile():
+    if hasattr(os, "sendfile"):
+        return lambda src, dst: os.sendfile(dst, src, None, _CHUNK_SIZE)
+    
+    function = _get_libc_function("sendfile", "c_ssize_t",
+        ("c_int", "c_int", "c_void_p", "c_size_t"))
+    if function:
+        return lambda src, dst: function(dst, src, None, _CHUNK_SIZE)
+    return None
+
+def _copy_by_buffer(source, dest):
+    shutil.copyfileobj(source, dest, 1024 * 1024)
+    return True
+
+_copy_methods = [
+    ("reflink", _copy_by_reflink),
+    ("copy_file_range", _copy_by_syscall(_get_copy_file_range())),
+    ("sendfile", _copy_by_syscall(_get_sendfile())),
+    ("buffered copy", _copy_by_buffer)
+]
+
+def _get_offset_pointer(offset):
+    import ctypes
+    return ctypes.byref(ctypes.c_longlong(offset))
+
+def _copy_range_by_syscall(copy_chunk):
+    def copy(source, dest, offset, length):
+        if copy_chunk is None:
+            return False
+        
+        end = offset + length
+        while offset < end:
+            copied = copy_chunk(source.fileno(), dest.fileno(), offset,
+                min(end - offset, _CHUNK_SIZE))
+            if copied <= 0:
+                break
+            offset += copied
+        return True
+    return copy
+
+def _get_copy_file_range_at():
+    if hasattr(os, "copy_file_range"):
+        return lambda src, dst, offset, count: os.copy_file_range(src, dst,
+            count, offset)
+    
+    function = _get_libc_function("copy_file_range", "c_ssize_t",
+        ("c_int", "c_void_p", "c_int", "c_void_p", "c_size_t", "c_uint"))
+    if function:
+        return lambda src, dst, offset, count: function(src,
+            _get_offset_pointer(offset), dst, None, count, 0)
+    return None
+
+def _get_sendfile_at():
+    if hasattr(os, "sendfile"):
+        return lambda src, dst, offset, count: os.sendfile(dst, src, offset,
+            count)
+    
+    function = _get_libc_function("sendfile", "c_ssize_t",
+        ("c_int", "c_int", "c_void_p", "c_size_t"))
+    if function:
+        return lambda src, dst, offset, count: function(dst, src,
+            _get_offset_pointer(offset), count)
+    return None
+
+def _copy_range_by_buffer(source, dest, offset, length):
+    source.seek(offset)
+    while length > 0:
+        data = source.read(min(length, 1024 * 1024))
+        if not data:
+            break
+        dest.write(data)
+        length -= len(data)
+    return True
+
+_range_copy_methods = [
+    ("copy_file_range", _copy_range_by_syscall(_get_copy_file_range_at())),
+    ("sendfile", _copy_range_by_syscall(_get_sendfile_at())),
+    ("buffered copy", _copy_range_by_buffer)
+]
+
+def _link_file(source_path, dest_path):
+    # link to a temporary name first so that an existing file at the
+    # destination is replaced atomically
+    temp_path = "%s.%d.link" % (dest_path, os.getpid())
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        return False
+    
+    try:
+        os.rename(temp_path, dest_path)
+    except OSError:
+        os.remove(temp_path)
+        return False
+    return True
+
+def copy_file(source_path, dest_path, link=False):
+    """
+    Copies a file, along with its permissions and modification time, letting
+    the kernel do as much of the work as it can. Returns the name of the
+    method that was used.
+    
+    If `link` is true, the destination is made a hard link to the source when
+    possible; only do this if nothing will modify the source file afterwards.
+    Otherwise, the copy is made by cloning the file's blocks on filesystems
+    that support it (such as Btrfs and XFS), then by `copy_file_range` or
+    `sendfile`, which copy without passing the data through user space, and
+    as a last resort by reading and writing buffers.
+    """
+    
+    if link and _link_file(source_path, dest_path):
+        return "link"
+    
+    with open(source_path, "rb") as source:
+        with open(dest_path, "wb") as dest:
+            for name, method in _copy_methods:
+                try:
+                    if method(source, dest):
                         break
-            
-            time.sleep(0.5)
+                except (IOError, OSError), e:
+                    if e.errno not in _UNSUPPORTED_ERRORS:
+                        raise
+                
+                # start over with the next method
+                source.seek(0)
+                dest.seek(0)
+                dest.truncate()
     
-    def add(self, item):
-        self._schedule(item, 0)
+    shutil.copystat(source_path, dest_path)
+    return name
+
+def copy_range(source, dest, offset, length):
+    """
+    Appends `length` bytes of the open file `source`, starting at `offset`,
+    to the end of the open file `dest`, by the first of the methods used by
+    `copy_file` (other than cloning) that works. The position of `source` is
+    not used. Returns the name of the method that was used.
+    """
     
-    def _schedule(self, item, attempt):
-        delay = (1.6 ** attempt) if attempt > 0 else 0
+    dest.flush()
+    start = dest.tell()
+    for name, method in _range_copy_methods:
+        try:
+            if method(source, dest, offset, length):
+                break
+        except (IOError, OSError), e:
+            if e.errno not in _UNSUPPORTED_ERRORS:
+                raise
         
-        with self._queue_control:
-            self._queue.append((item, attempt, time.time() + delay))
+        # start over with the next method
+        dest.seek(start)
+        dest.truncate()
     
-    def shutdown(self):
-        self._running = False
+    # the data may have been written under the file object; catch it up
+    dest.seek(0, os.SEEK_END)
+    return name
+
+_EXTENSION_PATTERN = re.compile(r'(\.(part\d+|manifest))?\.\w+$')
+
+def get_file_extension(file_path):
+    """
+    Returns the extension that a recording's stored copy should be given.
+    The segments of a segmented recording and its manifest keep their
+    ".partNNN" or ".manifest" marker, so that they can be told apart once
+    stored under the same name.
+    """
+    
+    match = _EXTENSION_PATTERN.search(os.path.basename(file_path))
+    return match.group(0) if match else ""
 
 def compile_path_pattern(pattern):
     def path_formatter(fn):
@@ -106,7 +416,7 @@ def compile_path_pattern(pattern):
                         (filter_name, next + 1))
             
             segments.append(source)
-            
+        
         return segments
     
     segments = get_segments()
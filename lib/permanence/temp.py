@@ -2,18 +2,34 @@
 
 """
 Manages temporary files.
+
+Recordings are written to the spool, a temporary directory in which each
+recording gets its own uniquely-named file. Once a recording has been handed
+to its storage locations, the spool keeps count of how many of them still
+need it and deletes the file when they have all saved it.
 """
 
+from __future__ import with_statement
+
 from tempfile import mkdtemp, mkstemp
+import itertools
+import threading
+import time
 import os
+import os.path
 
-_state = dict(directory=None)
+_state = dict(directory=None, spool=None)
 
 def get_temp_directory():
     if not _state["directory"]:
         _state["directory"] = mkdtemp(prefix="permanence_")
     return _state["directory"]
 
+def get_spool():
+    if not _state["spool"]:
+        _state["spool"] = Spool(get_temp_directory())
+    return _state["spool"]
+
 def open_temp_file(prefix=None, suffix=None):
     temp_dir = get_temp_directory()
     descriptor, path = mkstemp(prefix=prefix, suffix=suffix, dir=temp_dir)
@@ -27,3 +43,120 @@ def create_temp_file(prefix=None, suffix=None):
     else:
         open_file.close()
         return path
+
+class Spool(object):
+    """
+    A directory that holds recordings until they have been stored.
+    
+    If a quota (in bytes) is set, `admit` refuses new recordings while the
+    recordings in the spool take up more space than that. Files allocated
+    with `counted` false (such as ring buffers, which take up a fixed amount
+    of space for as long as the recorder runs) do not count against it.
+    """
+    
+    def __init__(self, directory, quota=None):
+        self.directory = directory
+        self.quota = quota
+        self._references = {}
+        self._failed = set()
+        self._uncounted = set()
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+    
+    def allocate(self, name, suffix="", counted=True):
+        """
+        Returns a new path in the spool for a recording. The path includes the
+        given name, the current time and a serial number; no file is created.
+        If `counted` is false, the file does not count toward the quota.
+        """
+        
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        while True:
+            path = os.path.join(self.directory, "%s-%s-%d%s" % (name, stamp,
+                self._counter.next(), suffix))
+            if not os.path.exists(path):
+                break
+        
+        if not counted:
+            with self._lock:
+                self._uncounted.add(path)
+        return path
+    
+    def get_usage(self):
+        """
+        Returns the number of bytes used by the files in the spool that count
+        toward the quota.
+        """
+        
+        with self._lock:
+            uncounted = set(self._uncounted)
+        
+        usage = 0
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if path in uncounted:
+                continue
+            try:
+                usage += os.path.getsize(path)
+            except OSError:
+                pass
+        return usage
+    
+    def forget(self, path):
+        """Stops tracking an uncounted file once it has been deleted."""
+        
+        with self._lock:
+            self._uncounted.discard(path)
+    
+    def admit(self):
+        """
+        Returns True if there is room in the spool to start another
+        recording.
+        """
+        
+        return not self.quota or self.get_usage() < self.quota
+    
+    def retain(self, path, count=1):
+        """
+        Records that `count` more consumers (storage locations) need the file
+        at the given path.
+        """
+        
+        with self._lock:
+            self._references[path] = self._references.get(path, 0) + count
+    
+    def get_consumers(self, path):
+        """
+        Returns the number of consumers that still need the file at the given
+        path (0 for files the spool is not keeping track of).
+        """
+        
+        with self._lock:
+            return self._references.get(path, 0)
+    
+    def release(self, path, succeeded=True, count=1):
+        """
+        Records that `count` consumers of the file at the given path are done
+        with it. When the last consumer is done, the file is deleted, unless one of
+        them failed; such files are kept for the sake of recovering them by
+        hand.
+        """
+        
+        with self._lock:
+            if not succeeded:
+                self._failed.add(path)
+            
+            remaining = self._references.get(path, 0) - count
+            if remaining > 0:
+                self._references[path] = remaining
+                return
+            
+            self._references.pop(path, None)
+            if path in self._failed:
+                self._failed.discard(path)
+                return
+        
+        try:
+            os.remove(path)
+        except OSError:
+            pass
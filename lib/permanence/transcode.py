@@ -0,0 +1,230 @@
+# encoding: utf-8
+
+"""
+Converts recordings into the encodings that their storage locations ask for.
+
+A storage location may declare an `encoding`, either as the name of a format
+("flac", "mp3", ...) or as a mapping with a `format` and, optionally, a
+`bitrate`, `sample_rate` and `channels`. Recordings are converted with
+ffmpeg before being given to such locations; locations without an encoding
+get the recording as it was captured.
+
+Each recording is converted by a single ffmpeg process that decodes it once
+and writes every encoding its locations need. At most `pool_size` of these
+processes (by default, one per processor) run at once, so that the shows
+that end together are converted in parallel without overloading the
+machine.
+"""
+
+from __future__ import with_statement
+
+from permanence.event import EventSource
+from permanence.storage.util import ActionQueue, get_file_extension
+import multiprocessing
+import subprocess
+import threading
+import traceback
+import re
+import os
+
+# format name -> (ffmpeg encoder, file extension)
+FORMATS = {
+    "flac": ("flac", ".flac"),
+    "mp3": ("libmp3lame", ".mp3"),
+    "ogg": ("libvorbis", ".ogg"),
+    "vorbis": ("libvorbis", ".ogg"),
+    "opus": ("libopus", ".opus"),
+    "aac": ("aac", ".m4a"),
+    "wav": ("pcm_s16le", ".wav")
+}
+
+class Encoding(object):
+    """An audio format, along with the settings to encode it with."""
+    
+    def __init__(self, format, bitrate=None, sample_rate=None,
+        channels=None):
+        if format not in FORMATS:
+            raise ValueError("unknown encoding format %r" % format)
+        self.format = format
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.channels = channels
+    
+    @property
+    def extension(self):
+        return FORMATS[self.format][1]
+    
+    @property
+    def label(self):
+        """A short name for the encoding, for use in file names."""
+        
+        parts = [self.format]
+        for value in (self.bitrate, self.sample_rate, self.channels):
+            if value:
+                parts.append(str(value))
+        return re.sub(r'\W+', '', "_".join(parts)).lower()
+    
+    def get_arguments(self):
+        """Returns the ffmpeg output options for the encoding."""
+        
+        arguments = ["-c:a", FORMATS[self.format][0]]
+        if self.bitrate:
+            arguments.extend(["-b:a", str(self.bitrate)])
+        if self.sample_rate:
+            arguments.extend(["-ar", str(self.sample_rate)])
+        if self.channels:
+            arguments.extend(["-ac", str(self.channels)])
+        return arguments
+    
+    def _key(self):
+        return (self.format, self.bitrate, self.sample_rate, self.channels)
+    
+    def __eq__(self, other):
+        return isinstance(other, Encoding) and self._key() == other._key()
+    
+    def __ne__(self, other):
+        return not (self == other)
+    
+    def __hash__(self):
+        return hash(self._key())
+    
+    def __repr__(self):
+        return "%s(%r, %r, %r, %r)" % ((type(self).__name__,) + self._key())
+
+def parse_encoding(definition):
+    """
+    Creates an `Encoding` from its definition in the configuration. Raises a
+    ValueError if the definition is invalid.
+    """
+    
+    if isinstance(definition, basestring):
+        return Encoding(definition.strip().lower())
+    elif not isinstance(definition, dict) or not definition.get("format"):
+        raise ValueError("an encoding must be a format name, or a mapping "
+            "that gives the format")
+    
+    sample_rate = definition.get("sample_rate")
+    channels = definition.get("channels")
+    return Encoding(str(definition["format"]).strip().lower(),
+        definition.get("bitrate"), sample_rate and int(sample_rate),
+        channels and int(channels))
+
+class TranscodeJob(object):
+    """
+    A recording being converted for its storage locations.
+    
+    `targets` maps each encoding to the storage drivers that want it;
+    `outputs` maps each encoding to the file it was converted into, once
+    conversion has succeeded. If it failed, `error` says why.
+    """
+    
+    def __init__(self, source, show, file_path, targets):
+        self.source = source
+        self.show = show
+        self.file_path = file_path
+        self.targets = targets
+        self.outputs = {}
+        self.error = None
+    
+    def get_output_path(self, encoding):
+        # keep any segment marker, so that storage drivers name the
+        # converted file like the original
+        extension = get_file_extension(self.file_path)
+        marker = re.sub(r'\.\w+$', '', extension)
+        base = self.file_path[:len(self.file_path) - len(extension)]
+        return "%s-%s%s%s" % (base, encoding.label, marker,
+            encoding.extension)
+
+class Transcoder(EventSource):
+    """
+    Runs conversion jobs in a bounded pool of ffmpeg processes, and fires
+    "complete" (job) when each job has succeeded or failed.
+    """
+    
+    def __init__(self, pool_size=None, executable="ffmpeg"):
+        super(Transcoder, self).__init__()
+        self.executable = executable
+        self.pool_size = pool_size or multiprocessing.cpu_count()
+        self._pending = 0
+        self._idle_callbacks = []
+        self._lock = threading.Lock()
+        self._queue = ActionQueue(self._run_job, self.pool_size,
+            max_attempts=1, failure_handler=self._job_failed)
+    
+    def transcode(self, source, show, file_path, targets):
+        """
+        Converts the recording at the given path into each of the encodings
+        in `targets`, a mapping of encodings to the storage drivers that
+        want them.
+        """
+        
+        job = TranscodeJob(source, show, file_path, targets)
+        with self._lock:
+            self._pending += 1
+        self._queue.add(job)
+        return job
+    
+    def when_idle(self, callback):
+        """
+        Calls the given callback once no jobs are waiting or running, which
+        may be right away.
+        """
+        
+        with self._lock:
+            if self._pending:
+                self._idle_callbacks.append(callback)
+                return
+        callback()
+    
+    def shutdown(self):
+        self._queue.shutdown(drain=True)
+    
+    def get_command(self, job):
+        command = [self.executable, "-nostdin", "-v", "error", "-y", "-i",
+            job.file_path]
+        for encoding in job.targets:
+            path = job.get_output_path(encoding)
+            command.extend(["-map", "0:a"] + encoding.get_arguments() +
+                [path])
+        return command
+    
+    def _run_job(self, job):
+        black_hole = open(os.devnull or "/dev/null", "r+")
+        try:
+            process = subprocess.Popen(self.get_command(job),
+                stdin=black_hole, stdout=black_hole, stderr=subprocess.PIPE)
+            output = process.communicate()[1]
+        finally:
+            black_hole.close()
+        
+        if process.returncode != 0:
+            lines = output.strip().splitlines()
+            raise RuntimeError("ffmpeg exited with status %d%s" %
+                (process.returncode, (": %s" % lines[-1]) if lines else ""))
+        
+        for encoding in job.targets:
+            job.outputs[encoding] = job.get_output_path(encoding)
+        self._job_finished(job)
+    
+    def _job_failed(self, job, error_type, error, trace):
+        for encoding in job.targets:
+            try:
+                os.remove(job.get_output_path(encoding))
+            except OSError:
+                pass
+        job.error = error
+        self._job_finished(job)
+    
+    def _job_finished(self, job):
+        try:
+            self.fire("complete", job=job)
+        except Exception:
+            traceback.print_exc()
+        
+        with self._lock:
+            self._pending -= 1
+            callbacks = []
+            if not self._pending:
+                callbacks, self._idle_callbacks = self._idle_callbacks, []
+        for callback in callbacks:
+            callback()
@@ -0,0 +1,68 @@
+# encoding: utf-8
+
+"""
+Tests of batched hook delivery by the hook invoker.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "lib"))
+
+from permanence.run import HookInvoker
+
+class Named(object):
+    def __init__(self, name):
+        self.name = name
+
+class BatchedHookTest(unittest.TestCase):
+    def setUp(self):
+        self.invoker = HookInvoker(1)
+        self.batches = []
+        self.delivered = threading.Event()
+    
+    def tearDown(self):
+        self.invoker.stop()
+    
+    def register(self, name, batch_size):
+        def hook(events):
+            self.batches.append(events)
+            self.delivered.set()
+        
+        self.invoker.create_hook(name)
+        self.invoker.register_hook(name, hook, "test", batch_size=batch_size,
+            batch_delay=5.0)
+    
+    def test_distinct_events_are_all_delivered(self):
+        self.register("show_save", 2)
+        source, show = Named("source"), Named("show")
+        for location in ("fs:/a", "sftp:/b"):
+            self.invoker.invoke("show_save", source=source, show=show,
+                location=location)
+        
+        self.delivered.wait(5.0)
+        self.assertTrue(self.delivered.isSet())
+        self.assertEqual(1, len(self.batches))
+        self.assertEqual(["fs:/a", "sftp:/b"],
+            [event["location"] for event in self.batches[0]])
+    
+    def test_state_events_are_coalesced(self):
+        self.register("show_schedule", 2)
+        source = Named("source")
+        for show_name, start_time in (("one", 1), ("one", 2), ("two", 3)):
+            self.invoker.invoke("show_schedule", source=source,
+                show=Named(show_name), start_time=start_time)
+        
+        self.delivered.wait(5.0)
+        self.assertTrue(self.delivered.isSet())
+        self.assertEqual(1, len(self.batches))
+        self.assertEqual([2, 3],
+            [event["start_time"] for event in self.batches[0]])
+
+if __name__ == "__main__":
+    unittest.main()
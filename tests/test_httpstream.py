@@ -0,0 +1,169 @@
+# encoding: utf-8
+
+"""
+Smoke tests of the in-process HTTP stream source, recording from a local
+SimpleHTTPServer that serves audio files as if they were streams.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import SocketServer
+import SimpleHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "lib"))
+
+from permanence.source.httpstream import HTTPStreamDriver
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class StreamServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Recording(object):
+    """Waits for a session to finish and remembers how it ended."""
+    
+    def __init__(self, session):
+        self.session = session
+        self.filename = None
+        self.error = None
+        self.segments = []
+        self._ended = threading.Event()
+        session.observe("done", self._done)
+        session.observe("error", self._error)
+        session.observe("segment", self._segment)
+    
+    def _done(self, session, filename):
+        self.filename = filename
+        self._ended.set()
+    
+    def _error(self, session, error):
+        self.error = error
+        self._ended.set()
+    
+    def _segment(self, session, filename, index):
+        self.segments.append((index, filename))
+    
+    def wait(self, timeout=10.0):
+        self._ended.wait(timeout)
+        return self._ended.isSet()
+
+class HTTPStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="permanence_test_")
+        self.data = {}
+        for name in ("one.mp3", "two.ogg"):
+            self.data[name] = os.urandom(200000)
+            with open(os.path.join(self.directory, name), "wb") as audio:
+                audio.write(self.data[name])
+        
+        self.server = StreamServer(("127.0.0.1", 0), self._make_handler())
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.files = []
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+        for path in self.files:
+            if path and os.path.exists(path):
+                os.remove(path)
+    
+    def _make_handler(self):
+        # SimpleHTTPServer serves from the working directory; serve the
+        # test's directory instead
+        directory = self.directory
+        class Handler(QuietHandler):
+            def translate_path(self, path):
+                return os.path.join(directory, path.lstrip("/"))
+        return Handler
+    
+    def get_url(self, name):
+        return "http://127.0.0.1:%d/%s" % (self.server.server_address[1],
+            name)
+    
+    def record(self, driver, duration=1.0):
+        recording = Recording(driver.spawn("Test Show"))
+        recording.session.start(duration)
+        return recording
+    
+    def read(self, path):
+        self.files.append(path)
+        with open(path, "rb") as recorded:
+            return recorded.read()
+    
+    def test_record_stream(self):
+        driver = HTTPStreamDriver(self.get_url("one.mp3"),
+            reconnect_delay=0.05)
+        recording = self.record(driver)
+        
+        self.assertTrue(recording.wait())
+        self.assertEqual(None, recording.error)
+        self.assertTrue(recording.filename.endswith(".mp3"))
+        # the server ends the "stream" after each copy of the file, and the
+        # session reconnects; it must at least have the first copy
+        self.assertTrue(self.read(recording.filename).startswith(
+            self.data["one.mp3"]))
+    
+    def test_concurrent_streams(self):
+        drivers = [HTTPStreamDriver(self.get_url(name), reconnect_delay=0.05)
+            for name in ("one.mp3", "two.ogg")]
+        recordings = [self.record(driver) for driver in drivers]
+        
+        for recording, name in zip(recordings, ("one.mp3", "two.ogg")):
+            self.assertTrue(recording.wait())
+            self.assertEqual(None, recording.error)
+            self.assertEqual(os.path.splitext(name)[1],
+                os.path.splitext(recording.filename)[1])
+            self.assertTrue(self.read(recording.filename).startswith(
+                self.data[name]))
+    
+    def test_segmented_recording(self):
+        driver = HTTPStreamDriver(self.get_url("one.mp3"),
+            reconnect_delay=0.05, segment_length=0.5)
+        recording = self.record(driver, 1.6)
+        
+        self.assertTrue(recording.wait())
+        self.assertEqual(None, recording.error)
+        self.assertTrue(recording.filename.endswith(".manifest.json"))
+        with open(recording.filename) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.files.append(recording.filename)
+        
+        self.assertTrue(len(recording.segments) >= 2)
+        self.assertEqual(len(recording.segments), len(manifest["segments"]))
+        for (index, path), segment in zip(recording.segments,
+            manifest["segments"]):
+            self.assertTrue(path.endswith(segment["suffix"]))
+            self.assertEqual(segment["size"], len(self.read(path)))
+    
+    def test_unreachable_stream(self):
+        # find a port that nothing is listening on
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        
+        driver = HTTPStreamDriver("http://127.0.0.1:%d/live" % port,
+            reconnect_delay=0.05)
+        recording = self.record(driver, 0.5)
+        
+        self.assertTrue(recording.wait())
+        self.assertTrue(recording.error)
+        self.assertEqual(None, recording.filename)
+
+if __name__ == "__main__":
+    unittest.main()
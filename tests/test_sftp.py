@@ -0,0 +1,231 @@
+# encoding: utf-8
+
+"""
+Tests of the SFTP storage driver's connection pool and remote directory
+cache, with connections made by a stub instead of over the network.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "lib"))
+
+try:
+    from permanence.storage import sftp
+except ImportError:
+    sftp = None
+
+class StubSFTP(object):
+    """Records the calls made to a pretend SFTP server."""
+    
+    def __init__(self):
+        self.directories = set(["/"])
+        self.calls = []
+        self.healthy = True
+    
+    def normalize(self, path):
+        self.calls.append(("normalize", path))
+        if not self.healthy:
+            raise IOError("connection lost")
+        return path
+    
+    def stat(self, path):
+        self.calls.append(("stat", path))
+        if path not in self.directories:
+            raise IOError("no such file: %s" % path)
+    
+    def mkdir(self, path):
+        self.calls.append(("mkdir", path))
+        self.directories.add(path)
+
+class StubConnection(object):
+    def __init__(self):
+        self.sftp = StubSFTP()
+        self.last_used = time.time()
+        self.alive = True
+        self.closed = False
+    
+    def is_alive(self):
+        return self.alive
+    
+    def close(self):
+        self.closed = True
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        if sftp is None:
+            self.skipTest("paramiko is not installed")
+        self.connections = []
+        self.pool = sftp.SFTPConnectionPool(self.connect)
+    
+    def tearDown(self):
+        if sftp is not None:
+            self.pool.close()
+    
+    def connect(self):
+        connection = StubConnection()
+        self.connections.append(connection)
+        return connection
+    
+    def borrow(self):
+        with self.pool.connection() as connection:
+            return connection
+    
+    def test_connection_is_reused(self):
+        first = self.borrow()
+        second = self.borrow()
+        
+        self.assertTrue(first is second)
+        self.assertEqual(1, len(self.connections))
+    
+    def test_concurrent_borrowers_get_their_own_connections(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                self.assertFalse(first is second)
+        self.assertEqual(2, len(self.connections))
+    
+    def test_connection_is_closed_after_error(self):
+        try:
+            with self.pool.connection() as connection:
+                raise IOError("upload failed")
+        except IOError:
+            pass
+        
+        self.assertTrue(connection.closed)
+        self.assertFalse(self.borrow() is connection)
+    
+    def test_dead_connection_is_replaced(self):
+        first = self.borrow()
+        first.alive = False
+        
+        self.assertFalse(self.borrow() is first)
+        self.assertTrue(first.closed)
+    
+    def test_idle_connection_is_checked_before_reuse(self):
+        first = self.borrow()
+        first.last_used -= self.pool.check_after + 1
+        
+        self.assertTrue(self.borrow() is first)
+        self.assertEqual([("normalize", ".")], first.sftp.calls)
+    
+    def test_recent_connection_is_not_checked(self):
+        first = self.borrow()
+        
+        self.assertTrue(self.borrow() is first)
+        self.assertEqual([], first.sftp.calls)
+    
+    def test_failed_check_replaces_connection(self):
+        first = self.borrow()
+        first.last_used -= self.pool.check_after + 1
+        first.sftp.healthy = False
+        
+        self.assertFalse(self.borrow() is first)
+        self.assertTrue(first.closed)
+    
+    def test_idle_connections_are_evicted(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                pass
+        first.last_used -= self.pool.max_idle + 1
+        self.pool.evict_idle()
+        
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+        self.assertTrue(self.borrow() is second)
+    
+    def test_close_closes_idle_connections(self):
+        first = self.borrow()
+        self.pool.close()
+        
+        self.assertTrue(first.closed)
+
+class SharedPoolTest(unittest.TestCase):
+    def setUp(self):
+        if sftp is None:
+            self.skipTest("paramiko is not installed")
+        self.pools = []
+    
+    def tearDown(self):
+        for pool in self.pools:
+            sftp.release_connection_pool(pool)
+    
+    def get(self, host, port, username, credentials):
+        pool = sftp.get_connection_pool(host, port, username, None,
+            credentials)
+        self.pools.append(pool)
+        return pool
+    
+    def test_same_server_and_credentials_share_a_pool(self):
+        first = self.get("example.com", 22, "tester", ("secret", None))
+        second = self.get("example.com", 22, "tester", ("secret", None))
+        
+        self.assertTrue(first is second)
+        self.assertEqual(2, first.users)
+    
+    def test_pools_are_keyed_by_server_user_and_credentials(self):
+        base = self.get("example.com", 22, "tester", ("secret", None))
+        others = [
+            self.get("example.org", 22, "tester", ("secret", None)),
+            self.get("example.com", 2222, "tester", ("secret", None)),
+            self.get("example.com", 22, "other", ("secret", None)),
+            self.get("example.com", 22, "tester", ("changed", None)),
+            self.get("example.com", 22, "tester", ("secret", "id_rsa"))
+        ]
+        
+        for pool in others:
+            self.assertFalse(pool is base)
+    
+    def test_pool_is_dropped_with_its_last_user(self):
+        first = self.get("example.com", 22, "tester", ())
+        self.get("example.com", 22, "tester", ())
+        sftp.release_connection_pool(self.pools.pop())
+        sftp.release_connection_pool(self.pools.pop())
+        
+        self.assertFalse(self.get("example.com", 22, "tester", ()) is first)
+
+class DirectoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        if sftp is None:
+            self.skipTest("paramiko is not installed")
+        # a user of its own, so that no other test's pool (and directory
+        # cache) is shared
+        self.driver = sftp.SFTPDriver(("localhost", 22),
+            lambda source, show: "/shows/test", self.id(), workers=1)
+        self.server = StubSFTP()
+    
+    def tearDown(self):
+        if sftp is not None:
+            self.driver.shutdown()
+    
+    def test_missing_directories_are_created(self):
+        self.driver._ensure_path(self.server, "/shows/2024/show.mp3")
+        
+        self.assertEqual([("mkdir", "/shows"), ("mkdir", "/shows/2024")],
+            [call for call in self.server.calls if call[0] == "mkdir"])
+    
+    def test_known_directories_are_not_checked_again(self):
+        self.driver._ensure_path(self.server, "/shows/2024/show.mp3")
+        del self.server.calls[:]
+        self.driver._ensure_path(self.server, "/shows/2024/other.mp3")
+        self.driver._ensure_path(self.server, "/shows/another.mp3")
+        
+        self.assertEqual([], self.server.calls)
+    
+    def test_forgotten_directories_are_checked_again(self):
+        self.driver._ensure_path(self.server, "/shows/2024/show.mp3")
+        self.driver._pool.forget_directory("/shows/2024")
+        self.server.directories.discard("/shows/2024")
+        self.server.directories.discard("/shows")
+        del self.server.calls[:]
+        self.driver._ensure_path(self.server, "/shows/2024/show.mp3")
+        
+        self.assertEqual([("mkdir", "/shows"), ("mkdir", "/shows/2024")],
+            [call for call in self.server.calls if call[0] == "mkdir"])
+
+if __name__ == "__main__":
+    unittest.main()
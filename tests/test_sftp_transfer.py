@@ -0,0 +1,170 @@
+# encoding: utf-8
+
+"""
+Smoke tests of resumable transfers by the SFTP storage driver, against an
+in-memory stand-in for a paramiko SFTP client.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "lib"))
+
+try:
+    from permanence.storage import sftp
+except ImportError:
+    sftp = None
+
+class StubAttributes(object):
+    def __init__(self, size):
+        self.st_size = size
+
+class StubRemoteFile(object):
+    def __init__(self, server, path, mode):
+        self.server = server
+        self.path = path
+        self.position = 0
+        if "w" in mode:
+            server.files[path] = ""
+        elif path not in server.files:
+            raise IOError("no such file: %s" % path)
+    
+    def set_pipelined(self, pipelined):
+        pass
+    
+    def seek(self, offset):
+        self.position = offset
+    
+    def read(self, size):
+        data = self.server.files[self.path]
+        block = data[self.position:self.position + size]
+        self.position += len(block)
+        return block
+    
+    def write(self, block):
+        data = self.server.files[self.path]
+        self.server.files[self.path] = (data[:self.position] + block +
+            data[self.position + len(block):])
+        self.position += len(block)
+        self.server.written += len(block)
+    
+    def check(self, hash_algorithm, offset, length):
+        if not self.server.check_file:
+            raise IOError("check-file extension not supported")
+        data = self.server.files[self.path][offset:offset + length]
+        return hashlib.new(hash_algorithm, data).digest()
+    
+    def close(self):
+        pass
+
+class StubSFTP(object):
+    """Keeps the files of a pretend SFTP server in a dictionary."""
+    
+    def __init__(self, check_file=False):
+        self.files = {}
+        self.directories = set(["/"])
+        self.check_file = check_file
+        self.written = 0
+    
+    def open(self, path, mode="rb"):
+        return StubRemoteFile(self, path, mode)
+    
+    def stat(self, path):
+        if path in self.files:
+            return StubAttributes(len(self.files[path]))
+        elif path in self.directories:
+            return StubAttributes(0)
+        raise IOError("no such file: %s" % path)
+    
+    def mkdir(self, path):
+        self.directories.add(path)
+    
+    def posix_rename(self, old_path, new_path):
+        self.files[new_path] = self.files.pop(old_path)
+    
+    def remove(self, path):
+        del self.files[path]
+    
+    def normalize(self, path):
+        return path
+
+class ResumableUploadTest(unittest.TestCase):
+    SIZE = 300000
+    
+    def setUp(self):
+        if sftp is None:
+            self.skipTest("paramiko is not installed")
+        
+        self.data = os.urandom(self.SIZE)
+        descriptor, self.local_path = tempfile.mkstemp(suffix=".mp3")
+        with os.fdopen(descriptor, "wb") as local_file:
+            local_file.write(self.data)
+        
+        self.driver = sftp.SFTPDriver(("localhost", 22),
+            lambda source, show: "/shows/test", "tester", workers=1)
+        self.driver.block_size = 4096
+    
+    def tearDown(self):
+        if sftp is not None:
+            self.driver.shutdown()
+            os.remove(self.local_path)
+    
+    def upload(self, server):
+        self.driver._ensure_path(server, "/shows/test.mp3")
+        self.driver._transfer(server, self.local_path, "/shows/test.mp3")
+    
+    def test_fresh_upload(self):
+        server = StubSFTP()
+        self.upload(server)
+        
+        self.assertEqual(self.data, server.files["/shows/test.mp3"])
+        self.assertFalse("/shows/test.mp3.part" in server.files)
+        self.assertEqual(self.SIZE, server.written)
+    
+    def test_resume_by_sampling(self):
+        server = StubSFTP()
+        server.files["/shows/test.mp3.part"] = self.data[:100000]
+        self.upload(server)
+        
+        self.assertEqual(self.data, server.files["/shows/test.mp3"])
+        self.assertEqual(self.SIZE - 100000, server.written)
+    
+    def test_resume_by_remote_hash(self):
+        server = StubSFTP(check_file=True)
+        server.files["/shows/test.mp3.part"] = self.data[:123456]
+        self.upload(server)
+        
+        self.assertEqual(self.data, server.files["/shows/test.mp3"])
+        self.assertEqual(self.SIZE - 123456, server.written)
+    
+    def test_damaged_partial_upload_is_replaced(self):
+        server = StubSFTP()
+        server.files["/shows/test.mp3.part"] = self.data[:99999] + "!"
+        self.upload(server)
+        
+        self.assertEqual(self.data, server.files["/shows/test.mp3"])
+        self.assertEqual(self.SIZE, server.written)
+    
+    def test_oversized_partial_upload_is_replaced(self):
+        server = StubSFTP()
+        server.files["/shows/test.mp3.part"] = self.data + "extra"
+        self.upload(server)
+        
+        self.assertEqual(self.data, server.files["/shows/test.mp3"])
+        self.assertEqual(self.SIZE, server.written)
+    
+    def test_existing_destination_is_replaced(self):
+        server = StubSFTP()
+        server.files["/shows/test.mp3"] = "old recording"
+        self.upload(server)
+        
+        self.assertEqual(self.data, server.files["/shows/test.mp3"])
+
+if __name__ == "__main__":
+    unittest.main()